@@ -3,101 +3,67 @@ from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import json
 import yaml
-import logging
-import logging.config
-import time
-import random
 import os
+import tempfile
 from connexion import NoContent
-from pykafka import KafkaClient
-from pykafka.exceptions import KafkaException
+from common.event_bus import make_consumer, make_lag_reader
+from common.http_cache import init_http_cache
+from common.logs import setup_logging
+from common.metrics import KAFKA_TOPIC_SCAN, init_metrics, metrics_response
 
 # Load configuration from shared config mount (per-service folder)
 with open('/config/analyzer/app_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    if 'handlers' in log_config and 'file' in log_config['handlers']:
-        log_config['handlers']['file']['filename'] = '/logs/analyzer.log'
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
-
-
-class KafkaConsumerWrapper:
-    """Thread-safe Kafka consumer wrapper with retry logic for analyzer"""
-    def __init__(self, hostname, topic):
-        self.hostname = hostname
-        self.topic = topic
-        self.client = None
-        self.consumer = None
-        self.connect()
-    
-    def connect(self):
-        """Infinite loop: will keep trying until connected"""
-        while True:
-            logger.debug("Trying to connect to Kafka...")
-            if self.make_client():
-                if self.make_consumer():
-                    break
-            # Sleep for random amount of time (0.5 to 1.5s)
-            time.sleep(random.randint(500, 1500) / 1000)
-    
-    def make_client(self):
-        """Creates Kafka client. Returns True on success, False on failure"""
-        if self.client is not None:
-            return True
-        try:
-            self.client = KafkaClient(hosts=self.hostname)
-            logger.info("Kafka client created!")
-            return True
-        except KafkaException as e:
-            logger.warning(f"Kafka error when making client: {e}")
-            self.client = None
-            self.consumer = None
-            return False
-    
-    def make_consumer(self):
-        """Creates Kafka consumer. Returns True on success, False on failure"""
-        if self.consumer is not None:
-            return True
-        if self.client is None:
-            return False
-        try:
-            topic = self.client.topics[str.encode(self.topic)]
-            self.consumer = topic.get_simple_consumer(
-                reset_offset_on_start=True,
-                consumer_timeout_ms=10000  # 10 seconds to ensure all messages are read
-            )
-            logger.info(f"Kafka consumer created for topic {self.topic}")
-            return True
-        except KafkaException as e:
-            logger.warning(f"Kafka error when making consumer: {e}")
-            self.client = None
-            self.consumer = None
-            return False
-    
-    def get_consumer(self):
-        """Returns a fresh consumer that reads from beginning"""
-        # Always create a new consumer to ensure we read from start
-        self.consumer = None
-        self.connect()
-        return self.consumer
-
-
-# Create global Kafka consumer wrapper (reused across all requests)
-hosts = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-kafka_wrapper = KafkaConsumerWrapper(hosts, app_config['events']['topic'])
-logger.info(f"Connected to Kafka brokers at {hosts}, topic={app_config['events']['topic']}")
+# Load logging configuration (queue-backed handlers)
+logger = setup_logging('analyzer')
 
 
+# Lag of the latest complete replay: its positions vs. the head of the topic
+replay_lag = make_lag_reader(app_config['events'], None)
+# Positions of the latest complete replay in any server worker, so every worker reports the same lag
+REPLAY_POSITIONS_FILE = os.path.join(tempfile.gettempdir(), "analyzer.replay_positions.json")
+logger.info(f"Replaying events from: backend={app_config['events'].get('backend', 'kafka')}, topic={app_config['events']['topic']}")
+
+
+def replay_events():
+    """Yields every decoded message on the topic, oldest first.
+
+    Each scan has its own consumer, so concurrent requests never rewind or
+    stop each other's.
+    """
+    consumer = make_consumer(app_config['events'], from_beginning=True,
+                             timeout_ms=10000)  # 10 seconds to ensure all messages are read
+    try:
+        for msg in consumer.messages():
+            yield json.loads(msg.value.decode('utf-8'))
+        save_replay_positions(consumer.positions)
+    finally:
+        consumer.stop()
+
+
+def save_replay_positions(positions):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(REPLAY_POSITIONS_FILE))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(positions, f)
+    # Replaced in one step, so readers never see a half-written file
+    os.replace(tmp_file, REPLAY_POSITIONS_FILE)
+
+
+def load_replay_positions():
+    try:
+        with open(REPLAY_POSITIONS_FILE, 'r') as f:
+            return {int(pid): offset for pid, offset in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+@KAFKA_TOPIC_SCAN.labels(operation="get_passenger_event").time()
 def get_passenger_event(index: int):
     """Return the passenger_count payload at given index."""
     try:
-        consumer = kafka_wrapper.get_consumer()
         count = 0
-        for msg in consumer:
-            data = json.loads(msg.value.decode('utf-8'))
+        for data in replay_events():
             if data.get('type') == 'passenger_count':
                 if count == index:
                     logger.debug("Fetched passenger_count index=%d trace_id=%s", index, data['payload'].get('trace_id'))
@@ -107,18 +73,15 @@ def get_passenger_event(index: int):
         return {"message": f"No message at index {index}!"}, 404
     except Exception as e:
         logger.error(f"Error fetching passenger event: {e}")
-        # Reset consumer on error
-        kafka_wrapper.consumer = None
         return {"message": "Error fetching event"}, 500
 
 
+@KAFKA_TOPIC_SCAN.labels(operation="get_wait_time_event").time()
 def get_wait_time_event(index: int):
     """Return the wait_time payload at given index."""
     try:
-        consumer = kafka_wrapper.get_consumer()
         count = 0
-        for msg in consumer:
-            data = json.loads(msg.value.decode('utf-8'))
+        for data in replay_events():
             if data.get('type') == 'wait_time':
                 if count == index:
                     logger.debug("Fetched wait_time index=%d trace_id=%s", index, data['payload'].get('trace_id'))
@@ -128,19 +91,16 @@ def get_wait_time_event(index: int):
         return {"message": f"No message at index {index}!"}, 404
     except Exception as e:
         logger.error(f"Error fetching wait_time event: {e}")
-        # Reset consumer on error
-        kafka_wrapper.consumer = None
         return {"message": "Error fetching event"}, 500
 
 
+@KAFKA_TOPIC_SCAN.labels(operation="get_stats").time()
 def get_stats():
     """Return counts of passenger_count and wait_time events."""
     try:
-        consumer = kafka_wrapper.get_consumer()
         num_passenger = 0
         num_wait = 0
-        for msg in consumer:
-            data = json.loads(msg.value.decode('utf-8'))
+        for data in replay_events():
             t = data.get('type')
             if t == 'passenger_count':
                 num_passenger += 1
@@ -151,17 +111,39 @@ def get_stats():
         return res, 200
     except Exception as e:
         logger.error(f"Error computing stats: {e}")
-        # Reset consumer on error
-        kafka_wrapper.consumer = None
         return {"message": "Error computing stats"}, 500
 
 
+def get_consumer_lag():
+    """How far behind the head of the topic the latest replay got"""
+    try:
+        replay_lag.positions = load_replay_positions()
+        return replay_lag.lag(), 200
+    except Exception as e:
+        logger.warning(f"Could not fetch consumer lag: {e}")
+        return {"message": "Consumer lag unavailable"}, 503
+
+
 def health():
     """Health check endpoint"""
     return {"status": "ok"}, 200
 
 
+def metrics():
+    """Prometheus metrics endpoint"""
+    return metrics_response()
+
+
 app = connexion.FlaskApp(__name__, specification_dir='')
+init_metrics(app)
+# Every lookup replays the topic; let clients and the proxy reuse results for http_cache.max_age seconds
+analyzer_max_age = app_config.get('http_cache', {}).get('max_age', 5)
+init_http_cache(app, {
+    "app.get_stats": analyzer_max_age,
+    "app.get_passenger_event": analyzer_max_age,
+    "app.get_wait_time_event": analyzer_max_age,
+    "app.get_consumer_lag": analyzer_max_age,
+})
 
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
@@ -0,0 +1,113 @@
+"""Microbenchmark for the event bus and the per-message service code around it.
+
+Pushes receiver-shaped messages through common.event_bus and reports:
+
+    produce   - receiver side: build + stamp + json encode + produce
+    consume   - storage side: consume + decode + stamp + commit (no DB)
+    replay    - analyzer side: rewind + full topic scan + count by type
+
+The memory backend (default) removes the broker from the measurement so the
+numbers reflect our own code. Pass --config with a service app_conf.yml to run
+the same workload against the configured Kafka backend instead.
+
+Usage (from the repo root):
+    PYTHONPATH=. python benchmark/bus_benchmark.py --messages 100000
+    PYTHONPATH=. python benchmark/bus_benchmark.py --config config/storage/app_conf.yml --messages 5000
+"""
+import argparse
+import datetime
+import json
+import time
+import uuid
+
+import yaml
+
+from common.event_bus import make_consumer, make_producer
+from common.tracing import next_trace_id, stamp
+
+
+def make_message(i):
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    msg = {
+        "type": "passenger_count" if i % 2 == 0 else "wait_time",
+        "datetime": now,
+        "payload": {
+            "trace_id": next_trace_id(),
+            "station_id": str(uuid.UUID(int=i % 50)),
+            "station_name": "Benchmark Station",
+            "transit_system": "Benchmark Transit",
+            "passenger_count": i % 500,
+            "batch_timestamp": now,
+            "recorded_timestamp": now,
+        },
+    }
+    stamp(msg, "received")
+    return msg
+
+
+def timed(name, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return {"stage": name, "messages": count, "seconds": round(elapsed, 4),
+            "messages_per_sec": round(count / elapsed) if elapsed else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure event bus + service hot-path throughput")
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--config', help="service app_conf.yml whose events section to use (default: memory backend)")
+    parser.add_argument('--topic', default="bus_benchmark")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config, 'r') as f:
+            events_config = dict(yaml.safe_load(f.read())['events'])
+    else:
+        events_config = {"backend": "memory"}
+    events_config['topic'] = args.topic
+
+    producer = make_producer(events_config)
+    # Join the group before producing so it starts at the current head of the topic
+    consumer = make_consumer(events_config, consumer_group="bus_benchmark", timeout_ms=5000)
+    replayer = make_consumer(events_config, from_beginning=True, timeout_ms=5000)
+
+    def produce():
+        for i in range(args.messages):
+            producer.produce(json.dumps(make_message(i)).encode('utf-8'))
+
+    def consume():
+        seen = 0
+        for msg in consumer.messages():
+            msg_obj = json.loads(msg.value.decode('utf-8'))
+            stamp(msg_obj, "consumed")
+            consumer.commit()
+            seen += 1
+            if seen == args.messages:
+                break
+
+    def replay():
+        counts = {}
+        replayer.rewind()
+        for msg in replayer.messages():
+            t = json.loads(msg.value.decode('utf-8')).get('type')
+            counts[t] = counts.get(t, 0) + 1
+
+    results = [
+        timed("produce", args.messages, produce),
+        timed("consume", args.messages, consume),
+        timed("replay", args.messages, replay),
+    ]
+    producer.stop()
+
+    print(f"backend={events_config.get('backend', 'kafka')}")
+    for r in results:
+        print(f"{r['stage']:<10}{r['messages']:>10} msgs {r['seconds']:>10}s {r['messages_per_sec']:>12} msgs/s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
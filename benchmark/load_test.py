@@ -0,0 +1,324 @@
+"""Load generator and end-to-end benchmark for the train pipeline.
+
+Posts synthetic station batches to the receiver at a fixed rate, samples
+the rest of the pipeline while the load runs, and writes a JSON report:
+
+    - accepted readings/sec and POST latency percentiles (receiver)
+    - consumer lag of storage's event_group on the events topic (Kafka)
+    - rows/sec landing in MySQL (storage's committed offsets, /storage/events/lag)
+    - how long processing takes to count everything that was sent
+    - storage's per-hop trace latency (/storage/trace/latency)
+
+Runs against the docker compose stack on this box (nginx on port 80 by
+default). Kafka lag is only sampled when --kafka-hosts is given, e.g.
+localhost:9092 for the compose OUTSIDE listener.
+
+Usage:
+    python load_test.py --rate 20 --batch-size 10 --duration 60
+    python load_test.py --replay sample_requests.jsonl --rate 5 --duration 30
+    python load_test.py --kafka-hosts localhost:9092 --output report.json
+"""
+import argparse
+import datetime
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+import httpx
+
+ENDPOINTS = {
+    "passenger_count": "/receiver/na_train/passenger_count",
+    "incoming_train": "/receiver/na_train/incoming_train",
+}
+ALERTS = ["none", "maintenance_needed", "full", "alarm_active", "other"]
+# (station_id, station_name), drawn from the seeded RNG in main()
+STATIONS = []
+
+
+def make_stations(count):
+    """Station ids from the module RNG, so --seed reproduces them too"""
+    return [(str(uuid.UUID(int=random.getrandbits(128), version=4)), f"Load Test Station {i}")
+            for i in range(count)]
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def make_batch(kind, size):
+    """Builds one synthetic receiver batch of `size` readings"""
+    station_id, station_name = random.choice(STATIONS)
+    ts = now_iso()
+    if kind == "passenger_count":
+        readings = [{"passenger_count": random.randint(0, 500), "recorded_timestamp": ts} for _ in range(size)]
+    else:
+        readings = [{"current_minutes_wait": random.randint(0, 30),
+                     "active_alerts": random.choice(ALERTS),
+                     "recorded_timestamp": ts} for _ in range(size)]
+    return {
+        "station_id": station_id,
+        "station_name": station_name,
+        "transit_system": "Load Test Transit",
+        "reporting_timestamp": ts,
+        "readings": readings,
+    }
+
+
+def load_replay(path):
+    """Reads {"endpoint": "passenger_count"|"incoming_train", "body": {...}} lines"""
+    requests = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                requests.append((item["endpoint"], item["body"]))
+    return requests
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    values = sorted(values)
+    result = {}
+    for pct in pcts:
+        result[f"p{pct}"] = round(values[max(math.ceil(pct / 100 * len(values)), 1) - 1], 2) if values else None
+    result["max"] = round(values[-1], 2) if values else None
+    return result
+
+
+class LoadGenerator:
+    """Sends batches from a pool of threads, paced to a global target rate"""
+    def __init__(self, base_url, rate, batch_size, duration, workers, replay=None):
+        self.base_url = base_url
+        self.rate = rate
+        self.batch_size = batch_size
+        self.duration = duration
+        self.workers = workers
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.accepted_batches = 0
+        self.accepted_readings = 0
+        self.errors = {}
+        self.latencies_ms = []
+
+    def next_request(self, n):
+        if self.replay:
+            return self.replay[n % len(self.replay)]
+        kind = "passenger_count" if n % 2 == 0 else "incoming_train"
+        return kind, make_batch(kind, self.batch_size)
+
+    def worker(self, index, start):
+        interval = self.workers / self.rate
+        n = index
+        with httpx.Client(base_url=self.base_url, timeout=10) as client:
+            while True:
+                # Worker i owns send slots i, i + workers, ... so the pool hits `rate` in total
+                due = start + (n // self.workers) * interval + index * interval / self.workers
+                if due - start >= self.duration:
+                    return
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                kind, body = self.next_request(n)
+                sent_at = time.perf_counter()
+                try:
+                    status = client.post(ENDPOINTS[kind], json=body).status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed_ms = (time.perf_counter() - sent_at) * 1000
+                with self.lock:
+                    self.sent += 1
+                    self.latencies_ms.append(elapsed_ms)
+                    if status == 201:
+                        self.accepted_batches += 1
+                        self.accepted_readings += len(body["readings"])
+                    else:
+                        self.errors[str(status)] = self.errors.get(str(status), 0) + 1
+                n += self.workers
+
+    def run(self):
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.worker, args=(i, start), daemon=True) for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        return {
+            "seconds": round(elapsed, 2),
+            "batches_sent": self.sent,
+            "batches_accepted": self.accepted_batches,
+            "readings_accepted": self.accepted_readings,
+            "accepted_readings_per_sec": round(self.accepted_readings / elapsed, 1),
+            "errors": self.errors,
+            "post_latency_ms": percentiles(self.latencies_ms),
+        }
+
+
+def kafka_lag(hosts, topic, consumer_group):
+    """Sum over partitions of (high watermark - committed offset) for a consumer group"""
+    from pykafka import KafkaClient
+    from pykafka.protocol import PartitionOffsetFetchRequest
+
+    client = KafkaClient(hosts=hosts)
+    kafka_topic = client.topics[topic.encode()]
+    latest = {pid: res.offset[0] for pid, res in kafka_topic.latest_available_offsets().items()}
+    coordinator = client.cluster.get_group_coordinator(consumer_group.encode())
+    preqs = [PartitionOffsetFetchRequest(topic.encode(), pid) for pid in latest]
+    response = coordinator.fetch_consumer_group_offsets(consumer_group.encode(), preqs)
+    committed = response.topics.get(topic.encode()) or response.topics.get(topic) or {}
+    lag = 0
+    for pid, head in latest.items():
+        pres = committed.get(pid)
+        # Offset fetch returns the next offset to consume, or -1 when nothing is committed
+        offset = pres.offset if pres is not None and pres.offset >= 0 else 0
+        lag += max(head - offset, 0)
+    return lag
+
+
+class PipelineSampler:
+    """Polls Kafka lag, storage row counts and processing stats while the load runs"""
+    def __init__(self, client, interval, kafka_hosts=None, topic="events", consumer_group="event_group"):
+        self.client = client
+        self.interval = interval
+        self.kafka_hosts = kafka_hosts
+        self.topic = topic
+        self.consumer_group = consumer_group
+        self.samples = []
+        self.stopped = threading.Event()
+        self.committed_at_start = None
+
+    def storage_rows(self):
+        """Events storage committed since the first sample; each is one row or a hand-off to its retry tiers.
+
+        Read from its consumer lag report rather than range queries, which
+        would load the database being measured.
+        """
+        res = self.client.get("/storage/events/lag")
+        res.raise_for_status()
+        committed = res.json()["committed"]
+        if self.committed_at_start is None:
+            self.committed_at_start = committed
+        return committed - self.committed_at_start
+
+    def processing_total(self):
+        res = self.client.get("/processing/stats")
+        if res.status_code != 200:
+            return None
+        stats = res.json()
+        return stats.get("num_passengers_readings", 0) + stats.get("num_wait_time_readings", 0)
+
+    def sample(self):
+        entry = {"t": round(time.perf_counter(), 3)}
+        try:
+            entry["storage_rows"] = self.storage_rows()
+        except httpx.HTTPError as e:
+            entry["storage_error"] = str(e)
+        try:
+            entry["processing_total"] = self.processing_total()
+        except httpx.HTTPError as e:
+            entry["processing_error"] = str(e)
+        if self.kafka_hosts:
+            try:
+                entry["kafka_lag"] = kafka_lag(self.kafka_hosts, self.topic, self.consumer_group)
+            except Exception as e:
+                entry["kafka_error"] = str(e)
+        self.samples.append(entry)
+        return entry
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+
+def storage_rows_per_sec(samples):
+    """Peak and average insert rate between consecutive storage samples"""
+    rates = []
+    for prev, cur in zip(samples, samples[1:]):
+        if "storage_rows" in prev and "storage_rows" in cur and cur["t"] > prev["t"]:
+            rates.append((cur["storage_rows"] - prev["storage_rows"]) / (cur["t"] - prev["t"]))
+    if not rates:
+        return {"avg": None, "peak": None}
+    return {"avg": round(sum(rates) / len(rates), 1), "peak": round(max(rates), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the receiver and measure the whole pipeline")
+    parser.add_argument('--base-url', default="http://localhost")
+    parser.add_argument('--rate', type=float, default=10, help="batches per second")
+    parser.add_argument('--batch-size', type=int, default=10, help="readings per batch")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--replay', help="jsonl file of requests to replay instead of synthetic batches")
+    parser.add_argument('--sample-interval', type=float, default=5)
+    parser.add_argument('--drain-timeout', type=float, default=120,
+                        help="seconds to wait after the load for storage/processing to catch up")
+    parser.add_argument('--kafka-hosts', help="broker list for lag sampling, e.g. localhost:9092")
+    parser.add_argument('--topic', default="events")
+    parser.add_argument('--consumer-group', default="event_group")
+    parser.add_argument('--seed', type=int, default=3855)
+    parser.add_argument('--output', default="load_test_report.json")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    STATIONS.extend(make_stations(50))
+    replay = load_replay(args.replay) if args.replay else None
+    client = httpx.Client(base_url=args.base_url, timeout=30)
+    since = now_iso()
+    sampler = PipelineSampler(client, args.sample_interval, args.kafka_hosts, args.topic, args.consumer_group)
+    baseline = sampler.sample()
+
+    print(f"Sending {args.rate} batches/s x {args.batch_size} readings for {args.duration}s to {args.base_url}")
+    sampler_thread = threading.Thread(target=sampler.loop, daemon=True)
+    sampler_thread.start()
+    load = LoadGenerator(args.base_url, args.rate, args.batch_size, args.duration, args.workers, replay).run()
+    load_end = time.perf_counter()
+    print(f"Accepted {load['readings_accepted']} readings ({load['accepted_readings_per_sec']}/s)")
+
+    # Wait for storage and processing to account for everything that was accepted
+    storage_caught_up = None
+    processing_caught_up = None
+    target_processing = (baseline.get("processing_total") or 0) + load["readings_accepted"]
+    while time.perf_counter() - load_end < args.drain_timeout:
+        entry = sampler.sample()
+        if storage_caught_up is None and entry.get("storage_rows", -1) >= load["readings_accepted"]:
+            storage_caught_up = round(entry["t"] - load_end, 2)
+        if processing_caught_up is None and (entry.get("processing_total") or 0) >= target_processing:
+            processing_caught_up = round(entry["t"] - load_end, 2)
+        if storage_caught_up is not None and processing_caught_up is not None:
+            break
+        time.sleep(1)
+    sampler.stopped.set()
+
+    trace_latency = None
+    res = client.get("/storage/trace/latency")
+    if res.status_code == 200:
+        trace_latency = res.json()
+
+    lags = [s["kafka_lag"] for s in sampler.samples if "kafka_lag" in s]
+    report = {
+        "started": since,
+        "settings": vars(args),
+        "receiver": load,
+        "kafka": {"max_lag": max(lags) if lags else None, "final_lag": lags[-1] if lags else None},
+        "storage": {
+            "rows_per_sec": storage_rows_per_sec(sampler.samples),
+            "rows_stored": sampler.samples[-1].get("storage_rows"),
+            "seconds_to_catch_up": storage_caught_up,
+        },
+        "processing": {"seconds_to_catch_up": processing_caught_up},
+        "trace_latency": trace_latency,
+        "samples": sampler.samples,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    for name, seconds in (("Storage", storage_caught_up), ("Processing", processing_caught_up)):
+        print(f"{name} caught up after {seconds}s" if seconds is not None
+              else f"{name} did not catch up within {args.drain_timeout}s")
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Code shared by all services. Copied into each image at /app/common."""
@@ -0,0 +1,587 @@
+"""Event bus used by receiver, storage and analyzer.
+
+Services never talk to pykafka directly; they build a producer or consumer
+from their `events` config section:
+
+    producer = make_producer(app_config['events'])
+    producer.produce(json.dumps(msg).encode('utf-8'))
+
+    consumer = make_consumer(app_config['events'], consumer_group='event_group')
+    for msg in consumer.messages():
+        ...
+        consumer.commit()
+
+    consumer.lag()   # committed offset vs. high watermark, per partition
+
+    make_lag_reader(app_config['events'], 'event_group').lag()   # the same, from any process
+
+A consumer is not thread-safe: concurrent readers each make their own and
+stop() it when done. All of a process's Kafka producers and consumers share
+one KafkaClient per broker address, so a consumer per request only costs its
+SimpleConsumer, not a new client and metadata bootstrap.
+
+`events.backend` picks the implementation:
+
+    kafka  - pykafka client with the reconnect/retry loops the services used to
+             carry individually (default)
+    memory - in-process topics with offsets and consumer groups. Nothing is
+             shared between processes: producers and consumers only see
+             each other inside one process (not across services or server
+             workers), which is what
+             microbenchmarks, load tests and profiling want: no broker, no
+             network, only our own code on the hot path.
+"""
+import abc
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import weakref
+
+from pykafka import KafkaClient
+from pykafka.common import CompressionType, OffsetType
+from pykafka.exceptions import KafkaException
+from pykafka.protocol import PartitionOffsetFetchRequest
+
+from common.metrics import (KAFKA_CONSUMER_LAG, KAFKA_CONSUMER_OFFSET, KAFKA_DELIVERY_LATENCY, KAFKA_HIGH_WATERMARK,
+                            KAFKA_MESSAGES, KAFKA_PRODUCE_LATENCY)
+
+logger = logging.getLogger('basicLogger')
+
+# Map compression names used in app_conf.yml to pykafka codecs
+COMPRESSION_TYPES = {
+    "none": CompressionType.NONE,
+    "gzip": CompressionType.GZIP,
+    "snappy": CompressionType.SNAPPY,
+    "lz4": CompressionType.LZ4,
+}
+
+
+def producer_settings(config):
+    """Build pykafka producer kwargs from the events.producer config section"""
+    config = dict(config or {})
+    compression = str(config.pop('compression', 'none')).lower()
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError(f"Unsupported Kafka compression: {compression}")
+    settings = {'compression': COMPRESSION_TYPES[compression]}
+    settings['sync'] = config.pop('sync', True)
+    # Without delivery reports an async producer never hears about failed sends
+    settings['delivery_reports'] = not settings['sync']
+    settings.update(config)
+    return settings
+
+
+def lag_report(topic, consumer_group, heads, offsets):
+    """Builds the lag report returned by consumer.lag() and publishes it as gauges.
+
+    heads maps partition id -> high watermark (next offset to be written),
+    offsets maps partition id -> the consumer's next offset, -1 if unknown.
+    Totals let callers derive produce/consume rates from two reports.
+    """
+    partitions = []
+    for pid in sorted(heads):
+        offset = offsets.get(pid, -1)
+        lag = max(heads[pid] - max(offset, 0), 0)
+        partitions.append({
+            "partition": pid,
+            "committed": offset if offset >= 0 else None,
+            "high_watermark": heads[pid],
+            "lag": lag,
+        })
+        labels = {"topic": topic, "consumer_group": consumer_group or "", "partition": str(pid)}
+        KAFKA_HIGH_WATERMARK.labels(**labels).set(heads[pid])
+        KAFKA_CONSUMER_OFFSET.labels(**labels).set(max(offset, 0))
+        KAFKA_CONSUMER_LAG.labels(**labels).set(lag)
+    return {
+        "topic": topic,
+        "consumer_group": consumer_group,
+        "committed": sum(p["committed"] or 0 for p in partitions),
+        "high_watermark": sum(p["high_watermark"] for p in partitions),
+        "lag": sum(p["lag"] for p in partitions),
+        "partitions": partitions,
+    }
+
+
+def retry_sleep():
+    """Sleep for random amount of time (0.5 to 1.5s)"""
+    time.sleep(random.randint(500, 1500) / 1000)
+
+
+# Broker address -> the KafkaClient shared by this process's connections
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+# Live connections, reset in a forked child
+CONNECTIONS = weakref.WeakSet()
+# The parent's clients, kept referenced in a forked child: their finalizers
+# would try to stop threads that only exist in the parent
+INHERITED_CLIENTS = []
+
+
+def shared_client(hostname):
+    """This process's KafkaClient for `hostname`, created on first use"""
+    with CLIENTS_LOCK:
+        if hostname not in CLIENTS:
+            CLIENTS[hostname] = KafkaClient(hosts=hostname)
+            logger.info("Kafka client created!")
+        return CLIENTS[hostname]
+
+
+def discard_client(hostname, client):
+    """Forgets a client that failed, so the next shared_client() call builds a new one"""
+    with CLIENTS_LOCK:
+        if CLIENTS.get(hostname) is client:
+            del CLIENTS[hostname]
+
+
+def after_fork_in_child():
+    INHERITED_CLIENTS.extend(CLIENTS.values())
+    CLIENTS.clear()
+    for connection in list(CONNECTIONS):
+        connection.after_fork()
+
+
+os.register_at_fork(after_in_child=after_fork_in_child)
+
+
+class KafkaConnection(abc.ABC):
+    """Uses the process's shared KafkaClient and replaces it after Kafka errors.
+
+    A process forked from the one that connected (e.g. a multiprocessing child)
+    cannot share its sockets or pykafka threads, so it reconnects on first use.
+    """
+    def __init__(self, hostname, topic):
+        self.hostname = hostname
+        self.topic = topic
+        self.client = None
+        self.inherited = None
+        CONNECTIONS.add(self)
+
+    def after_fork(self):
+        # Keep the parent's pykafka objects referenced: their finalizers would
+        # try to stop threads that only exist in the parent
+        self.inherited = dict(vars(self))
+        self.reset()
+
+    def connect(self):
+        """Infinite loop: will keep trying until connected"""
+        while True:
+            logger.debug("Trying to connect to Kafka...")
+            if self.make_client() and self.make_endpoint():
+                return
+            retry_sleep()
+
+    def make_client(self):
+        """Creates Kafka client. Returns True on success, False on failure"""
+        if self.client is not None:
+            return True
+        try:
+            self.client = shared_client(self.hostname)
+            return True
+        except KafkaException as e:
+            logger.warning(f"Kafka error when making client: {e}")
+            self.reset()
+            return False
+
+    @abc.abstractmethod
+    def make_endpoint(self):
+        """Creates the producer or consumer on self.client. Returns True on success, False on failure"""
+
+    def reset(self):
+        if self.client is not None:
+            discard_client(self.hostname, self.client)
+        self.client = None
+
+
+class KafkaProducer(KafkaConnection):
+    """Thread-safe Kafka producer with retry logic.
+
+    With sync=False produce() only queues the message, so it succeeds even
+    when Kafka is down. The outcome arrives later as a delivery report
+    (pykafka keeps them per producing thread); each thread collects its own
+    on its next produce() and counts them in kafka_messages_total. Messages
+    still queued when the process is killed without running stop() are lost.
+
+    produce(message, accepted_ns) also records how long after `accepted_ns`
+    (epoch ns) Kafka acknowledged the message, in kafka_delivery_seconds.
+    In async mode that includes the wait for the report to be collected.
+    """
+    def __init__(self, hostname, topic, settings=None):
+        super().__init__(hostname, topic)
+        self.settings = settings or {}
+        self.producer = None
+        # id of a queued pykafka message -> (message, accepted_ns), until its delivery report arrives
+        self.accepted = {}
+        self.connect()
+
+    def make_endpoint(self):
+        """Creates Kafka producer. Returns True on success, False on failure"""
+        if self.producer is not None:
+            return True
+        try:
+            topic = self.client.topics[str.encode(self.topic)]
+            self.producer = topic.get_producer(**self.settings)
+            logger.info(f"Kafka producer created for topic {self.topic} with settings {self.settings}")
+            return True
+        except KafkaException as e:
+            logger.warning(f"Kafka error when making producer: {e}")
+            self.reset()
+            return False
+
+    def reset(self):
+        super().reset()
+        self.producer = None
+
+    def produce(self, message, accepted_ns=None):
+        """Produces message with retry logic"""
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                if self.producer is None:
+                    self.connect()
+                with KAFKA_PRODUCE_LATENCY.labels(topic=self.topic).time():
+                    queued = self.producer.produce(message)
+                if self.settings.get('delivery_reports'):
+                    if accepted_ns is not None:
+                        self.accepted[id(queued)] = (queued, accepted_ns)
+                    self.collect_delivery_reports()
+                else:
+                    # Sync mode: produce() returned once Kafka acknowledged the message
+                    if accepted_ns is not None:
+                        KAFKA_DELIVERY_LATENCY.labels(topic=self.topic).observe((time.time_ns() - accepted_ns) / 1e9)
+                    KAFKA_MESSAGES.labels(topic=self.topic, direction="produced", outcome="ok").inc()
+                return True
+            except KafkaException as e:
+                logger.warning(f"Kafka error when producing (attempt {attempt+1}/{max_retries}): {e}")
+                self.reset()
+                if attempt < max_retries - 1:
+                    retry_sleep()
+                    self.connect()
+        logger.error("Failed to produce message after retries")
+        KAFKA_MESSAGES.labels(topic=self.topic, direction="produced", outcome="failed").inc()
+        return False
+
+    def collect_delivery_reports(self):
+        """Counts the delivered and failed messages reported back to this thread (async mode)"""
+        while True:
+            try:
+                message, error = self.producer.get_delivery_report(block=False)
+            except queue.Empty:
+                return
+            _, accepted_ns = self.accepted.pop(id(message), (None, None))
+            if error is None:
+                if accepted_ns is not None:
+                    KAFKA_DELIVERY_LATENCY.labels(topic=self.topic).observe((time.time_ns() - accepted_ns) / 1e9)
+                KAFKA_MESSAGES.labels(topic=self.topic, direction="produced", outcome="ok").inc()
+            else:
+                logger.error(f"Kafka could not deliver a queued message: {error}")
+                KAFKA_MESSAGES.labels(topic=self.topic, direction="produced", outcome="failed").inc()
+
+    def stop(self):
+        """Flushes any queued messages (async mode) and stops the producer"""
+        if self.producer is not None:
+            self.producer.stop()
+            if self.settings.get('delivery_reports'):
+                self.collect_delivery_reports()
+
+
+class KafkaConsumer(KafkaConnection):
+    """Kafka consumer with retry logic.
+
+    With a consumer group it resumes from the group's committed offset (or,
+    when nothing is committed, the head of the topic - the earliest offset
+    with auto_offset_reset="earliest"). With from_beginning it always starts
+    at the earliest offset. With timeout_ms > 0, messages()
+    ends once no message has arrived for that long.
+
+    lag() compares the group's committed offsets with the partition high
+    watermarks. Without a group it uses the offsets last handed out by
+    messages(), i.e. how far the latest replay got.
+    """
+    def __init__(self, hostname, topic, consumer_group=None, from_beginning=False, timeout_ms=-1, settings=None,
+                 auto_offset_reset="latest"):
+        super().__init__(hostname, topic)
+        self.consumer_group = consumer_group
+        self.from_beginning = from_beginning
+        self.earliest = from_beginning or auto_offset_reset == "earliest"
+        self.timeout_ms = timeout_ms
+        # Fetch tuning from events.consumer (fetch_min_bytes, fetch_wait_max_ms, queued_max_messages, ...)
+        self.settings = settings or {}
+        self.consumer = None
+        # Next offset per partition after the last message handed out (kept across rewinds)
+        self.positions = {}
+        # Separate client for lag queries so they never share sockets with the consume loop
+        self.lag_client = None
+        self.connect()
+
+    def make_endpoint(self):
+        """Creates Kafka consumer. Returns True on success, False on failure"""
+        if self.consumer is not None:
+            return True
+        try:
+            topic = self.client.topics[str.encode(self.topic)]
+            self.consumer = topic.get_simple_consumer(
+                consumer_group=self.consumer_group.encode() if self.consumer_group else None,
+                reset_offset_on_start=self.from_beginning,
+                auto_offset_reset=OffsetType.EARLIEST if self.earliest else OffsetType.LATEST,
+                consumer_timeout_ms=self.timeout_ms,
+                **self.settings
+            )
+            logger.info(f"Kafka consumer created for topic {self.topic}")
+            return True
+        except KafkaException as e:
+            logger.warning(f"Kafka error when making consumer: {e}")
+            self.reset()
+            return False
+
+    def reset(self):
+        super().reset()
+        self.consumer = None
+
+    def messages(self):
+        """Generator that reconnects on Kafka errors instead of raising"""
+        while True:
+            if self.consumer is None:
+                self.connect()
+            try:
+                for msg in self.consumer:
+                    if msg is not None:
+                        self.positions[msg.partition_id] = msg.offset + 1
+                        yield msg
+                # Iteration only ends on its own when timeout_ms expires
+                return
+            except KafkaException as e:
+                logger.warning(f"Kafka issue in consumer: {e}")
+                self.reset()
+
+    def rewind(self):
+        """Starts over from the beginning of the topic on the next messages() call"""
+        if self.consumer is not None:
+            self.consumer.stop()
+        # Keep the client, only rebuild the consumer so reset_offset_on_start applies again
+        self.consumer = None
+
+    def restart(self):
+        """Resumes from the group's committed offset on the next messages() call.
+
+        Everything read since the last commit is delivered again.
+        """
+        self.rewind()
+
+    def commit(self):
+        """Commits the consumer group's offsets up to the last message read"""
+        self.consumer.commit_offsets()
+
+    def lag(self):
+        """Committed offset vs. high watermark per partition (see lag_report)"""
+        try:
+            if self.lag_client is None:
+                self.lag_client = KafkaClient(hosts=self.hostname)
+            topic = self.lag_client.topics[str.encode(self.topic)]
+            heads = {pid: res.offset[0] for pid, res in topic.latest_available_offsets().items()}
+            if self.consumer_group:
+                offsets = self.group_offsets(heads)
+            else:
+                offsets = {pid: self.positions.get(pid, -1) for pid in heads}
+        except KafkaException:
+            self.lag_client = None
+            raise
+        return lag_report(self.topic, self.consumer_group, heads, offsets)
+
+    def group_offsets(self, heads):
+        """Asks the group coordinator for the committed offset of every partition"""
+        group = self.consumer_group.encode()
+        coordinator = self.lag_client.cluster.get_group_coordinator(group)
+        requests = [PartitionOffsetFetchRequest(self.topic.encode(), pid) for pid in heads]
+        response = coordinator.fetch_consumer_group_offsets(group, requests)
+        committed = response.topics.get(self.topic.encode()) or response.topics.get(self.topic) or {}
+        # Offset fetch returns the next offset to consume, or -1 when nothing is committed
+        return {pid: committed[pid].offset if pid in committed else -1 for pid in heads}
+
+    def after_fork(self):
+        super().after_fork()
+        self.lag_client = None
+
+    def stop(self):
+        if self.consumer is not None:
+            self.consumer.stop()
+
+
+class KafkaLagReader(KafkaConsumer):
+    """Reports a consumer group's lag without joining the topic or consuming.
+
+    Committed offsets live on the broker, so any process can read them, e.g.
+    server workers other than the one running the group's consumer. Without
+    a group it reports against `positions`, which the caller sets, e.g. to
+    where the latest replay got.
+    """
+    def connect(self):
+        # lag() only uses lag_client, created on first use
+        pass
+
+
+class MemoryMessage:
+    """Mirrors the attributes services use on pykafka messages"""
+    __slots__ = ("value", "offset", "partition_id")
+
+    def __init__(self, value, offset, partition_id=0):
+        self.value = value
+        self.offset = offset
+        self.partition_id = partition_id
+
+
+class MemoryTopic:
+    """Append-only log with per-consumer-group committed offsets (single partition)"""
+    def __init__(self, name):
+        self.name = name
+        self.log = []
+        self.committed = {}
+        self.changed = threading.Condition()
+
+    def append(self, value):
+        with self.changed:
+            self.log.append(value)
+            self.changed.notify_all()
+
+    def read(self, position, timeout):
+        """Returns the value at position, waiting up to timeout seconds (forever if None); None if nothing arrives"""
+        with self.changed:
+            if position >= len(self.log):
+                self.changed.wait_for(lambda: position < len(self.log), timeout)
+            if position < len(self.log):
+                return self.log[position]
+            return None
+
+
+class MemoryBroker:
+    """Process-wide registry of in-memory topics"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}
+
+    def topic(self, name):
+        with self.lock:
+            if name not in self.topics:
+                self.topics[name] = MemoryTopic(name)
+            return self.topics[name]
+
+
+BROKER = MemoryBroker()
+
+
+class MemoryProducer:
+    def __init__(self, topic):
+        self.topic = topic
+        self.log = BROKER.topic(topic)
+
+    def produce(self, message, accepted_ns=None):
+        with KAFKA_PRODUCE_LATENCY.labels(topic=self.topic).time():
+            self.log.append(message)
+        if accepted_ns is not None:
+            KAFKA_DELIVERY_LATENCY.labels(topic=self.topic).observe((time.time_ns() - accepted_ns) / 1e9)
+        KAFKA_MESSAGES.labels(topic=self.topic, direction="produced", outcome="ok").inc()
+        return True
+
+    def stop(self):
+        pass
+
+
+class MemoryConsumer:
+    """In-process consumer with the same offset semantics as KafkaConsumer.
+
+    With timeout_ms > 0, messages() ends as soon as the consumer has caught
+    up: an in-process log has nothing in flight, so waiting out the timeout
+    would only add idle time to replays. It only waits (up to timeout_ms)
+    when nothing at all is available, so polling loops do not spin.
+    """
+    def __init__(self, topic, consumer_group=None, from_beginning=False, timeout_ms=-1, auto_offset_reset="latest"):
+        self.topic = topic
+        self.log = BROKER.topic(topic)
+        self.consumer_group = consumer_group
+        self.from_beginning = from_beginning
+        self.earliest = from_beginning or auto_offset_reset == "earliest"
+        self.timeout_ms = timeout_ms
+        self.position = self.start_position()
+        # Next offset after the last message handed out, as on KafkaConsumer
+        self.positions = {}
+
+    def start_position(self):
+        if self.from_beginning:
+            return 0
+        if self.consumer_group in self.log.committed:
+            return self.log.committed[self.consumer_group]
+        return 0 if self.earliest else len(self.log.log)
+
+    def messages(self):
+        timeout = self.timeout_ms / 1000 if self.timeout_ms and self.timeout_ms > 0 else None
+        while True:
+            value = self.log.read(self.position, timeout)
+            if value is None:
+                if timeout is not None:
+                    return
+                continue
+            if timeout is not None:
+                # Caught up after this message: end instead of waiting out the timeout
+                timeout = 0
+            msg = MemoryMessage(value, self.position)
+            self.position += 1
+            self.positions[0] = self.position
+            yield msg
+
+    def rewind(self):
+        self.position = 0
+
+    def restart(self):
+        self.position = self.start_position()
+
+    def commit(self):
+        if self.consumer_group:
+            self.log.committed[self.consumer_group] = self.position
+
+    def lag(self):
+        if self.consumer_group:
+            offset = self.log.committed.get(self.consumer_group, -1)
+        else:
+            offset = self.positions.get(0, -1)
+        return lag_report(self.topic, self.consumer_group, {0: len(self.log.log)}, {0: offset})
+
+    def stop(self):
+        pass
+
+
+def kafka_hosts(events_config):
+    return f"{events_config['hostname']}:{events_config['port']}"
+
+
+def make_producer(events_config, topic=None):
+    """Producer for `topic` (default events.topic) on the configured backend"""
+    topic = topic or events_config['topic']
+    if events_config.get('backend', 'kafka') == 'memory':
+        return MemoryProducer(topic)
+    return KafkaProducer(kafka_hosts(events_config), topic, producer_settings(events_config.get('producer')))
+
+
+def make_lag_reader(events_config, consumer_group, topic=None):
+    """Lag of `consumer_group` on `topic` (default events.topic) without consuming anything.
+
+    With consumer_group=None, lag() measures against the reader's `positions`.
+    """
+    topic = topic or events_config['topic']
+    if events_config.get('backend', 'kafka') == 'memory':
+        return MemoryConsumer(topic, consumer_group)
+    return KafkaLagReader(kafka_hosts(events_config), topic, consumer_group)
+
+
+def make_consumer(events_config, consumer_group=None, from_beginning=False, timeout_ms=-1, topic=None,
+                  auto_offset_reset="latest"):
+    """Consumer for `topic` (default events.topic) on the configured backend.
+
+    auto_offset_reset ("latest" or "earliest") decides where a consumer group
+    with no committed offset starts.
+    """
+    topic = topic or events_config['topic']
+    if events_config.get('backend', 'kafka') == 'memory':
+        return MemoryConsumer(topic, consumer_group, from_beginning, timeout_ms, auto_offset_reset)
+    return KafkaConsumer(kafka_hosts(events_config), topic, consumer_group, from_beginning, timeout_ms,
+                         events_config.get('consumer'), auto_offset_reset)
@@ -0,0 +1,85 @@
+"""HTTP caching headers for the read APIs.
+
+Each service lists its cacheable GET operations with how long their result
+stays valid, usually the period of the job that refreshes it:
+
+    init_http_cache(app, {"app.get_stats": app_config['scheduler']['interval']})
+
+Successful responses of those operations get
+
+    Cache-Control: public, max-age=<seconds>
+    ETag: "<hash of the body>"
+
+and a request whose If-None-Match matches the ETag is answered 304 with no
+body. The dashboard proxy (dashboard/nginx.conf) caches on these headers and
+revalidates with If-None-Match, so backends only see one request per period
+however many clients poll. A handler can set its own Cache-Control (e.g.
+storage's immutable closed windows); it is left as is.
+"""
+import hashlib
+
+from connexion.middleware import MiddlewarePosition
+
+
+class CacheHeadersMiddleware:
+    """ASGI middleware adding Cache-Control/ETag to selected operations and answering conditional GETs.
+
+    Installed after connexion's routing middleware so the resolved
+    operationId is available in the scope. Responses of the selected
+    operations are buffered to hash them, so only list JSON endpoints here,
+    not streams.
+    """
+    def __init__(self, app, max_ages):
+        self.app = app
+        self.max_ages = max_ages
+
+    async def __call__(self, scope, receive, send):
+        routing = scope.get("extensions", {}).get("connexion_routing", {}) if scope["type"] == "http" else {}
+        max_age = self.max_ages.get(routing.get("operation_id"))
+        if max_age is None or scope.get("method") not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        start = {}
+        body = []
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            await self.respond(scope, start, b"".join(body), max_age, send)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def respond(self, scope, start, body, max_age, send):
+        headers = [(name, value) for name, value in start.get("headers", [])]
+        if start["status"] != 200:
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+            return
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'.encode()
+        headers.append((b"etag", etag))
+        if not any(name.lower() == b"cache-control" for name, _ in headers):
+            headers.append((b"cache-control", f"public, max-age={max_age}".encode()))
+        request_headers = dict(scope.get("headers", []))
+        if_none_match = request_headers.get(b"if-none-match", b"")
+        # nginx's gzip turns our ETags into weak ones (W/"..."), so compare ignoring the prefix
+        if etag in (tag.strip().removeprefix(b"W/") for tag in if_none_match.split(b",")):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() in (b"etag", b"cache-control", b"vary")]
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def init_http_cache(app, max_ages):
+    """Adds Cache-Control/ETag headers to the given {operationId: max-age seconds} on a connexion app"""
+    app.add_middleware(CacheHeadersMiddleware, position=MiddlewarePosition.BEFORE_SECURITY, max_ages=max_ages)
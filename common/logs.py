@@ -0,0 +1,128 @@
+"""Logging setup shared by every service.
+
+setup_logging() loads /config/log_conf.yml, points the file handler at the
+service's own log file and, when `async: true`, moves the real handlers
+behind a queue so request and consumer threads only pay for an enqueue.
+Console/file writes happen on a single QueueListener thread. Threads do not
+survive fork(), so a forked process (e.g. a multiprocessing child) starts its
+own listener and sampler threads.
+
+Per-event log lines go through an EventSampler, made by event_sampler() in
+the services that log per event: only a configurable ratio of them is
+written, and every `summary_interval` seconds one summary line per key
+reports how many events were seen vs. logged.
+"""
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import os
+import queue
+import threading
+
+import yaml
+
+LOGGER_NAME = 'basicLogger'
+
+
+def setup_logging(service, config_path='/config/log_conf.yml'):
+    """Configures logging for a service and returns its logger"""
+    with open(config_path, 'r') as f:
+        log_config = yaml.safe_load(f.read())
+    # Keys below are ours, not dictConfig's
+    use_queue = log_config.pop('async', False)
+    log_config.pop('sampling', None)
+    if 'handlers' in log_config and 'file' in log_config['handlers']:
+        log_config['handlers']['file']['filename'] = f'/logs/{service}.log'
+    logging.config.dictConfig(log_config)
+
+    if use_queue:
+        _install_queue(logging.getLogger(LOGGER_NAME))
+        _install_queue(logging.getLogger())
+
+    return logging.getLogger(LOGGER_NAME)
+
+
+def event_sampler(logger, config_path='/config/log_conf.yml'):
+    """EventSampler for `logger`, configured by the sampling section of log_conf.yml"""
+    with open(config_path, 'r') as f:
+        sampling = yaml.safe_load(f.read()).get('sampling', {}) or {}
+    return EventSampler(logger,
+                        ratios=sampling.get('ratios'),
+                        default_ratio=sampling.get('default_ratio', 1.0),
+                        summary_interval=sampling.get('summary_interval', 60))
+
+
+def _install_queue(logger):
+    """Replaces a logger's handlers with a QueueHandler feeding a background listener"""
+    handlers = list(logger.handlers)
+    if not handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    os.register_at_fork(after_in_child=lambda: _restart_listener(listener))
+
+
+def _restart_listener(listener):
+    """Starts a fresh listener thread in a forked child; the parent's thread was not copied"""
+    listener._thread = None
+    listener.start()
+
+
+class EventSampler:
+    """Samples high-volume per-event log lines and logs periodic summaries.
+
+    A ratio of 0.01 writes one line in every 100 events for that key, 1.0
+    writes all of them and 0 writes none (only the summary).
+    """
+    def __init__(self, logger, ratios=None, default_ratio=1.0, summary_interval=60):
+        self.logger = logger
+        self.ratios = ratios or {}
+        self.default_ratio = default_ratio
+        self.summary_interval = summary_interval
+        self.lock = threading.Lock()
+        self.seen = {}
+        self.logged = {}
+        self.stopped = threading.Event()
+        if summary_interval:
+            self._start_summaries()
+            os.register_at_fork(after_in_child=self._start_summaries)
+
+    def _start_summaries(self):
+        thread = threading.Thread(target=self._summary_loop, daemon=True)
+        thread.start()
+
+    def log(self, key, level, msg, *args):
+        """Counts an event under `key` and logs it if it falls in the sample"""
+        ratio = self.ratios.get(key, self.default_ratio)
+        with self.lock:
+            count = self.seen.get(key, 0) + 1
+            self.seen[key] = count
+            # Deterministic sampling: every (1 / ratio)-th event, starting with the first
+            sample = ratio > 0 and (count - 1) % max(round(1 / ratio), 1) == 0
+            if sample:
+                self.logged[key] = self.logged.get(key, 0) + 1
+        if sample and self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args)
+
+    def info(self, key, msg, *args):
+        self.log(key, logging.INFO, msg, *args)
+
+    def flush(self):
+        """Logs one summary line per key for events seen since the last flush"""
+        with self.lock:
+            seen, logged = self.seen, self.logged
+            self.seen, self.logged = {}, {}
+        for key in sorted(seen):
+            self.logger.info("%s: %d events in the last %ss (%d logged)",
+                             key, seen[key], self.summary_interval, logged.get(key, 0))
+
+    def _summary_loop(self):
+        while not self.stopped.wait(self.summary_interval):
+            self.flush()
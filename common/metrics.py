@@ -0,0 +1,195 @@
+"""Prometheus instrumentation shared by every service.
+
+Each service calls init_metrics(app) once after creating its connexion app
+and exposes metrics_response() through a /metrics operation in its OpenAPI
+spec. Hot paths time themselves with the histograms defined here, e.g.
+
+    with KAFKA_PRODUCE_LATENCY.labels(topic="events").time():
+        producer.produce(message)
+"""
+import os
+import time
+
+from connexion.middleware import MiddlewarePosition
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Buckets tuned for sub-millisecond Kafka/DB calls up to multi-second topic scans
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by OpenAPI operationId",
+    ["operation_id", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+KAFKA_PRODUCE_LATENCY = Histogram(
+    "kafka_produce_duration_seconds",
+    "Time spent handing a message to the Kafka producer",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+KAFKA_DELIVERY_LATENCY = Histogram(
+    "kafka_delivery_seconds",
+    "Time from an event being accepted to Kafka acknowledging its message",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+KAFKA_CONSUME_LATENCY = Histogram(
+    "kafka_consume_duration_seconds",
+    "Time spent processing one consumed Kafka message",
+    ["topic"],
+    buckets=LATENCY_BUCKETS,
+)
+KAFKA_MESSAGES = Counter(
+    "kafka_messages_total",
+    "Kafka messages produced or consumed",
+    ["topic", "direction", "outcome"],
+)
+CONSUMER_BATCH_SIZE = Histogram(
+    "kafka_consumer_batch_size",
+    "Messages stored and committed together by a batching consumer",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+KAFKA_HIGH_WATERMARK = Gauge(
+    "kafka_partition_high_watermark",
+    "Next offset to be written to each partition, as of the last lag check",
+    ["topic", "consumer_group", "partition"],
+    # Latest lag check by any live worker
+    multiprocess_mode="livemostrecent",
+)
+KAFKA_CONSUMER_OFFSET = Gauge(
+    "kafka_consumer_committed_offset",
+    "Committed (or, without a consumer group, consumed) offset per partition",
+    ["topic", "consumer_group", "partition"],
+    # Latest lag check by any live worker
+    multiprocess_mode="livemostrecent",
+)
+KAFKA_CONSUMER_LAG = Gauge(
+    "kafka_consumer_lag_messages",
+    "Messages between the consumer's offset and the high watermark",
+    ["topic", "consumer_group", "partition"],
+    # Latest lag check by any live worker
+    multiprocess_mode="livemostrecent",
+)
+KAFKA_TOPIC_SCAN = Histogram(
+    "kafka_topic_scan_duration_seconds",
+    "Time spent replaying a topic from the beginning",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+
+DB_SESSION_DURATION = Histogram(
+    "db_session_duration_seconds",
+    "Lifetime of a database session, by the function that opened it",
+    ["function"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_COMMIT_DURATION = Histogram(
+    "db_commit_duration_seconds",
+    "Time spent in session.commit()",
+    ["table"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    buckets=LATENCY_BUCKETS,
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections",
+    "Connections currently checked out of the pool",
+    # Each worker has its own pool; only live workers' connections count
+    multiprocess_mode="livesum",
+)
+
+RESULT_CACHE_REQUESTS = Counter(
+    "result_cache_requests_total",
+    "Range queries answered from the result cache (hit), loaded into it (miss) or not cacheable (bypass)",
+    ["cache", "table", "outcome"],
+)
+RESULT_CACHE_EVICTIONS = Counter(
+    "result_cache_evictions_total",
+    "Cached results evicted to stay under the cache's memory limit",
+    ["cache"],
+)
+RESULT_CACHE_BYTES = Gauge(
+    "result_cache_bytes",
+    "Size of the serialized results held in the cache",
+    ["cache"],
+    # One cache per worker
+    multiprocess_mode="livesum",
+)
+RESULT_CACHE_ENTRIES = Gauge(
+    "result_cache_entries",
+    "Results held in the cache",
+    ["cache"],
+    # One cache per worker
+    multiprocess_mode="livesum",
+)
+
+JOB_DURATION = Histogram(
+    "scheduled_job_duration_seconds",
+    "Duration of scheduled background jobs",
+    ["job"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording request latency per operationId.
+
+    Installed after connexion's routing middleware so the resolved
+    operationId is available in the scope.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        routing = scope.get("extensions", {}).get("connexion_routing", {})
+        operation_id = routing.get("operation_id") or "unknown"
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(
+                operation_id=operation_id,
+                method=scope.get("method", ""),
+                status=str(status["code"]),
+            ).observe(time.perf_counter() - start)
+
+
+def init_metrics(app):
+    """Installs request latency instrumentation on a connexion app"""
+    app.add_middleware(RequestMetricsMiddleware, position=MiddlewarePosition.BEFORE_SECURITY)
+
+
+def metrics_response():
+    """Body and status for a /metrics operation.
+
+    The content type comes from the spec (text/plain): connexion rejects the
+    versioned Prometheus content type because it is not listed there.
+
+    Under the multi-worker server (common/server.py) every worker writes its
+    samples to PROMETHEUS_MULTIPROC_DIR and the response adds them all up, so
+    it does not depend on which worker answers the scrape. Each gauge's
+    multiprocess_mode says how workers combine; "live" modes leave out
+    workers that have exited. Callback gauges (set_function) are not
+    reported, so gauges are always set explicitly.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), 200
+    return generate_latest(), 200
@@ -0,0 +1,135 @@
+"""Production entry point: runs a service's connexion app under gunicorn.
+
+    python3 -m common.server <service>     (the Dockerfiles' CMD)
+
+`python3 app.py` still starts the single-process development server. Here
+the app runs in `workers` uvicorn worker processes instead. Settings come
+from the `server:` section of /config/<service>/app_conf.yml:
+
+    port       port to bind on 0.0.0.0
+    workers    worker processes (default: 2)
+    timeout    seconds a silent worker may take before gunicorn restarts it
+
+Every worker imports the app itself; the app is never preloaded in the
+master. Importing starts threads (the logging QueueListener, pool and
+scheduler threads), and threads do not survive the fork into the workers.
+
+Background work (storage's consumer thread, the APScheduler jobs) must run
+once per container, not once per worker. A service exposes it as
+start_background() in app.py. Every worker calls run_once(), and only the
+worker holding an exclusive lock on /tmp/<service>.background.lock runs it.
+The other workers wait on the lock, so if that worker dies or is recycled,
+one of them takes over.
+
+Metrics are aggregated across workers through prometheus_client's
+multiprocess mode (PROMETHEUS_MULTIPROC_DIR), set up before the app and
+prometheus_client are imported.
+"""
+import fcntl
+import importlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import yaml
+
+logger = logging.getLogger('basicLogger')
+
+# Lock files held by this process; the kernel releases the locks when it exits
+LOCKS = []
+
+# Not one per CPU: every worker has its own database pools and Kafka clients,
+# so the worker count multiplies connections on shared backends
+DEFAULT_WORKERS = 2
+
+
+def run_once(name, start):
+    """Calls start() in this process once it holds the container-wide lock for `name`"""
+    path = os.path.join(tempfile.gettempdir(), f"{name}.background.lock")
+    lock_file = open(path, 'a')
+    LOCKS.append(lock_file)
+
+    def acquire():
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        logger.info("Worker %d is running the %s background work", os.getpid(), name)
+        start()
+
+    threading.Thread(target=acquire, name=f"{name}-background", daemon=True).start()
+
+
+def claim_slot(name, count):
+    """Index in [0, count) that no other live process in the container holds for `name`.
+
+    Each slot is an exclusive lock on /tmp/<name>.<index>.lock, held until
+    this process exits, so a recycled worker's slot is free for its
+    replacement. Raises RuntimeError when every slot is taken.
+    """
+    for index in range(count):
+        lock_file = open(os.path.join(tempfile.gettempdir(), f"{name}.{index}.lock"), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        LOCKS.append(lock_file)
+        return index
+    raise RuntimeError(f"All {count} {name} slots are held by other processes")
+
+
+def server_options(service, server_config):
+    if server_config.get('preload'):
+        raise ValueError("server.preload is not supported: the app must be imported in each worker")
+
+    def post_worker_init(worker):
+        start = getattr(sys.modules['app'], 'start_background', None)
+        if start is not None:
+            run_once(service, start)
+
+    def child_exit(server, worker):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+    return {
+        "bind": f"0.0.0.0:{server_config['port']}",
+        "workers": server_config.get('workers') or DEFAULT_WORKERS,
+        "worker_class": "uvicorn_worker.UvicornWorker",
+        "preload_app": False,
+        "timeout": server_config.get('timeout', 30),
+        "post_worker_init": post_worker_init,
+        "child_exit": child_exit,
+    }
+
+
+def main():
+    from gunicorn.app.base import BaseApplication
+
+    class ServiceApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return importlib.import_module('app').app
+
+    service = sys.argv[1]
+    with open(f'/config/{service}/app_conf.yml', 'r') as f:
+        server_config = yaml.safe_load(f.read()).get('server', {})
+
+    # Must be set before prometheus_client is first imported (by the app, in the master or the workers)
+    metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                        os.path.join(tempfile.gettempdir(), f"{service}_metrics"))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+    ServiceApplication(server_options(service, server_config)).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Pipeline stage timestamps keyed on trace_id.
+
+Every Kafka message carries a "stages" dict next to its payload. Each stage
+that touches the event adds an epoch-nanosecond timestamp:
+
+    received   -> receiver accepted the HTTP batch
+    consumed   -> storage pulled it off the topic
+    committed  -> storage committed the row to MySQL
+    aggregated -> the row was first returned to processing's range query
+                  (storage only sets it on reads that processing marks)
+
+The moment Kafka acknowledges a message is only known after it was sent, so
+it cannot travel inside it. The receiver records received -> acknowledged
+itself, from the delivery report, as kafka_delivery_seconds.
+
+TraceRecorder keeps the most recent events in memory and summarises
+end-to-end and per-hop latency percentiles over them. SharedTraceRecorder
+does the same for a service running in several server workers.
+
+next_trace_id() hands out the trace_ids themselves. They are 63-bit
+integers laid out like Sonyflake IDs, so they stay unique across receiver
+replicas and worker processes without any coordination:
+
+    39 bits  10 ms ticks since 2024-01-01 UTC (~174 years)
+     8 bits  sequence within the tick (256 IDs per tick per process)
+    16 bits  node id: 10 bits of TRACE_NODE_ID or of the container's IP
+             address, then a 6-bit slot claimed by the process
+"""
+import fcntl
+import ipaddress
+import json
+import logging
+import math
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from common.server import claim_slot
+
+logger = logging.getLogger('basicLogger')
+
+STAGES = ["received", "consumed", "committed", "aggregated"]
+
+# (name, from stage, to stage) reported by TraceRecorder.summary()
+HOPS = [
+    ("receiver_to_storage", "received", "consumed"),
+    ("storage_to_db", "consumed", "committed"),
+    ("db_to_processing", "committed", "aggregated"),
+    ("ingest_to_queryable", "received", "committed"),
+    ("end_to_end", "received", "aggregated"),
+]
+
+PERCENTILES = [50, 90, 99]
+
+TRACE_EPOCH_NS = 1704067200 * 10**9  # 2024-01-01T00:00:00Z
+TRACE_TICK_NS = 10 * 10**6
+SEQUENCE_BITS = 8
+NODE_BITS = 16
+SLOT_BITS = 6
+# trace_ids issued before this layout were time.time_ns() values, all at or
+# above this (2020-01-01 in epoch ns). New ids stay below it until 2053.
+LEGACY_TRACE_ID_MIN = 1577836800 * 10**9
+
+
+def stamp(message, stage, when=None):
+    """Adds a stage timestamp (epoch ns) to a message envelope and returns it"""
+    message.setdefault("stages", {})[stage] = when if when is not None else time.time_ns()
+    return message
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class TraceRecorder:
+    """Thread-safe bounded store of stage timestamps for recent trace_ids"""
+    def __init__(self, max_events=10000):
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()
+
+    def record(self, trace_id, event_type, stages):
+        """Stores (or merges) the stages seen so far for a trace_id"""
+        if trace_id is None:
+            return
+        with self.lock:
+            entry = self.traces.get(trace_id)
+            if entry is None:
+                entry = {"type": event_type, "stages": {}}
+                self.traces[trace_id] = entry
+                if len(self.traces) > self.max_events:
+                    self.traces.popitem(last=False)
+            entry["stages"].update(stages)
+
+    def mark(self, trace_ids, stage, when=None):
+        """Sets a stage on already recorded traces, keeping the first time it was seen"""
+        when = when if when is not None else time.time_ns()
+        with self.lock:
+            for trace_id in trace_ids:
+                entry = self.traces.get(trace_id)
+                if entry is not None:
+                    entry["stages"].setdefault(stage, when)
+
+    def summary(self, event_type=None):
+        """Latency percentiles in milliseconds for each hop over the recorded events"""
+        with self.lock:
+            entries = [dict(e["stages"]) for e in self.traces.values()
+                       if event_type is None or e["type"] == event_type]
+
+        hops = {}
+        for name, start, end in HOPS:
+            values = sorted((s[end] - s[start]) / 1e6 for s in entries if start in s and end in s)
+            stats = {"count": len(values)}
+            for pct in PERCENTILES:
+                value = percentile(values, pct)
+                stats[f"p{pct}"] = round(value, 3) if value is not None else None
+            stats["max"] = round(values[-1], 3) if values else None
+            hops[name] = stats
+        return {"events": len(entries), "hops": hops}
+
+
+class SharedTraceRecorder(TraceRecorder):
+    """TraceRecorder whose traces are visible to every server worker of a container.
+
+    Stages are recorded in one worker, the owner: the one running the
+    background work (e.g. storage's consumer, see common/server.py), which
+    calls own(). Other workers append their mark() calls to a spool file and
+    answer summary() from the summaries the owner publishes every
+    publish_interval seconds:
+
+        /tmp/<name>.trace_marks     one JSON line per mark(), applied and emptied by the owner
+        /tmp/<name>.trace_summary   {event type, or "" for all: summary()}
+    """
+    def __init__(self, name, max_events=10000, publish_interval=5):
+        super().__init__(max_events)
+        self.marks_file = os.path.join(tempfile.gettempdir(), f"{name}.trace_marks")
+        self.summary_file = os.path.join(tempfile.gettempdir(), f"{name}.trace_summary")
+        self.publish_interval = publish_interval
+        self.owner = False
+
+    def own(self):
+        """Makes this process the one recording traces and starts publishing its summaries"""
+        self.owner = True
+        threading.Thread(target=self.publish_forever, name="trace-publisher", daemon=True).start()
+
+    def mark(self, trace_ids, stage, when=None):
+        if self.owner:
+            super().mark(trace_ids, stage, when)
+            return
+        line = json.dumps([stage, when if when is not None else time.time_ns(), list(trace_ids)])
+        with open(self.marks_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line + "\n")
+
+    def apply_marks(self):
+        """Applies the marks spooled by other workers and empties the spool"""
+        try:
+            f = open(self.marks_file, 'r+')
+        except FileNotFoundError:
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            for line in f:
+                stage, when, trace_ids = json.loads(line)
+                super().mark(trace_ids, stage, when)
+            f.truncate(0)
+
+    def publish(self):
+        self.apply_marks()
+        with self.lock:
+            event_types = {e["type"] for e in self.traces.values() if e["type"]}
+        summaries = {"": super().summary()}
+        for event_type in event_types:
+            summaries[event_type] = super().summary(event_type)
+        tmp_file = self.summary_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(summaries, f)
+        os.replace(tmp_file, self.summary_file)
+
+    def publish_forever(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Could not publish trace summaries: {e}")
+            time.sleep(self.publish_interval)
+
+    def summary(self, event_type=None):
+        if self.owner:
+            return super().summary(event_type)
+        try:
+            with open(self.summary_file, 'r') as f:
+                summaries = json.load(f)
+        except (OSError, ValueError):
+            summaries = {}
+        # Nothing published for this type yet: the (empty) local summary has the same shape
+        return summaries.get(event_type or "") or super().summary(event_type)
+
+
+def default_node_id():
+    """10 bits of TRACE_NODE_ID (else of this host's IP address), then this process's slot.
+
+    Compose gives every receiver replica its own address on the project
+    network. Worker processes in one container claim distinct slots (see
+    common.server.claim_slot); pid bits would not do, as recycled workers
+    can share them and then hand out identical trace_ids.
+    """
+    host_bits = NODE_BITS - SLOT_BITS
+    if os.environ.get("TRACE_NODE_ID"):
+        host = int(os.environ["TRACE_NODE_ID"])
+    else:
+        try:
+            host = int(ipaddress.IPv4Address(socket.gethostbyname(socket.gethostname())))
+        except (OSError, ValueError):
+            host = random.getrandbits(host_bits)
+    return ((host & ((1 << host_bits) - 1)) << SLOT_BITS) | claim_slot("trace_node", 1 << SLOT_BITS)
+
+
+class TraceIdGenerator:
+    """Thread-safe generator of time-ordered, collision-resistant 63-bit trace_ids"""
+    def __init__(self, node_id=None):
+        self.node_id = node_id
+        self.lock = threading.Lock()
+        self.pid = None
+        self.node = None
+        self.tick = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # First call in this process (or in a forked worker): resolve the node id here
+                self.pid = os.getpid()
+                self.node = self.node_id if self.node_id is not None else default_node_id()
+                self.tick = -1
+            # Never go back in time, even if the wall clock does
+            tick = max((time.time_ns() - TRACE_EPOCH_NS) // TRACE_TICK_NS, self.tick)
+            if tick == self.tick:
+                self.sequence = (self.sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self.sequence == 0:
+                    # Sequence exhausted for this tick: borrow the next one instead of blocking
+                    tick += 1
+            else:
+                self.sequence = 0
+            self.tick = tick
+            return (tick << (SEQUENCE_BITS + NODE_BITS)) | (self.sequence << NODE_BITS) | self.node
+
+
+TRACE_IDS = TraceIdGenerator()
+
+
+def trace_id_at(when):
+    """Smallest trace_id generated at or after `when` (a datetime; naive means UTC).
+
+    trace_ids sort by time, so this turns a time boundary into a trace_id
+    range boundary, e.g. for storage's time-partitioned tables.
+    """
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    delta = when - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    ns = (delta.days * 86400 + delta.seconds) * 10**9 + delta.microseconds * 1000
+    tick = max(-(-(ns - TRACE_EPOCH_NS) // TRACE_TICK_NS), 0)
+    return tick << (SEQUENCE_BITS + NODE_BITS)
+
+
+def next_trace_id():
+    """A new trace_id from this process's generator"""
+    return TRACE_IDS.next_id()
@@ -1,70 +1,40 @@
 /* UPDATE THESE VALUES TO MATCH YOUR SETUP */
 
-const PROCESSING_STATS_API_URL = "/processing/stats"
-const ANALYZER_API_URL = {
-    stats: "/analyzer/stats",
-    passenger_count: "/analyzer/na_train/passenger_count",
-    incoming_train: "/analyzer/na_train/incoming_train"
-}
-const HEALTH_API_URL = "/health/health"
-
-// This function fetches and updates the general statistics
-const makeReq = (url, cb) => {
-    fetch(url)
-        .then(res => {
-            if (!res.ok) {
-                throw new Error(`HTTP error! status: ${res.status}`);
-            }
-            return res.json();
-        })
-        .then((result) => {
-            console.log("Received data: ", result)
-            cb(result);
-        }).catch((error) => {
-            console.error(`Error fetching ${url}:`, error);
-            updateErrorMessages(`${url}: ${error.message}`)
-        })
-}
-
-const makeReqQuery = (url, query, cb) => {
-    fetch(url + '?' + new URLSearchParams(query).toString())
-        .then(res => res.json())
-        .then((result) => {
-            console.log("Received data: ", result)
-            cb(result);
-        }).catch((error) => {
-            updateErrorMessages(error.message)
-        })
-}
+// Health, processing/analyzer stats and the newest events, pushed by the health service
+const LIVE_STATS_STREAM_URL = "/health/live/stream"
 
 const updateCodeDiv = (result, elemId) => document.getElementById(elemId).innerText = JSON.stringify(result)
 
 const getLocaleDateStr = () => (new Date()).toLocaleString()
 
-let max_passenger = 0
-let max_train = 0
+const formatConsumerLag = (consumers) => Object.entries(consumers).map(([name, c]) => {
+    if (c.lag === undefined) {
+        return `${name} consumer: ${c.status}`
+    }
+    const catchUp = c.catch_up_seconds === null ? "not catching up" : `catch-up ~${c.catch_up_seconds}s`
+    return `${name} consumer: ${c.status} - lag ${c.lag} (${catchUp})`
+}).join("\n")
 
-const getStats = () => {
-    document.getElementById("last-updated-value").innerText = getLocaleDateStr()
-    
-    makeReq(HEALTH_API_URL, (result) => {
+// How to display each key of the live stats snapshot
+const renderers = {
+    health: (result) => {
         const healthDisplay = `Receiver: ${result.receiver}\nStorage: ${result.storage}\nProcessing: ${result.processing}\nAnalyzer: ${result.analyzer}\nLast Updated: ${result.last_update}`
         document.getElementById("health-stats").innerText = healthDisplay
-    })
-    
-    makeReq(PROCESSING_STATS_API_URL, (result) => updateCodeDiv(result, "processing-stats"))
-    makeReq(ANALYZER_API_URL.stats, (result) => {
-        max_passenger = result.num_passenger_readings || 0;
-        max_train = result.num_wait_time_readings || 0;
-        updateCodeDiv(result, "analyzer-stats")
-    })
-    
-    if (max_passenger > 0) {
-        makeReqQuery(ANALYZER_API_URL.passenger_count, { index: Math.floor(Math.random() * max_passenger) }, (result) => updateCodeDiv(result, "event-passenger"))
-    }
-    if (max_train > 0) {
-        makeReqQuery(ANALYZER_API_URL.incoming_train, { index: Math.floor(Math.random() * max_train) }, (result) => updateCodeDiv(result, "event-train"))
-    }
+        document.getElementById("consumer-lag").innerText = formatConsumerLag(result.consumers || {})
+    },
+    processing: (result) => updateCodeDiv(result, "processing-stats"),
+    analyzer: (result) => updateCodeDiv(result, "analyzer-stats"),
+    passenger_count_event: (result) => result && updateCodeDiv(result, "event-passenger"),
+    wait_time_event: (result) => result && updateCodeDiv(result, "event-train"),
+    errors: (errors) => Object.entries(errors).forEach(([source, error]) => updateErrorMessages(`${source}: ${error}`)),
+}
+
+// Each event carries only the keys that changed (everything on the first event)
+const updateStats = (event) => {
+    const changes = JSON.parse(event.data)
+    console.log("Received data: ", changes)
+    Object.entries(changes).forEach(([key, value]) => renderers[key] && renderers[key](value))
+    document.getElementById("last-updated-value").innerText = getLocaleDateStr()
 }
 
 const updateErrorMessages = (message) => {
@@ -82,8 +52,10 @@ const updateErrorMessages = (message) => {
 }
 
 const setup = () => {
-    getStats()
-    setInterval(() => getStats(), 4000) // Update every 4 seconds
+    // One subscription per page; the browser reconnects by itself if it drops
+    const source = new EventSource(LIVE_STATS_STREAM_URL)
+    source.addEventListener("stats", updateStats)
+    source.onerror = () => updateErrorMessages(`${LIVE_STATS_STREAM_URL}: connection lost, reconnecting`)
 }
 
 document.addEventListener('DOMContentLoaded', setup)
\ No newline at end of file
@@ -2,8 +2,6 @@ import connexion
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import yaml
-import logging
-import logging.config
 import requests
 import json
 import datetime
@@ -11,23 +9,30 @@ import threading
 import time
 import os
 from apscheduler.schedulers.background import BackgroundScheduler
+from common.http_cache import init_http_cache
+from common.logs import setup_logging
+from live import LiveStatsCollector, LiveStatsStream, SnapshotBroadcaster
+from common.metrics import JOB_DURATION, init_metrics, metrics_response
 
 # Load configuration
 with open('/config/health/app_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
-# Load logging configuration
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    if 'handlers' in log_config and 'file' in log_config['handlers']:
-        log_config['handlers']['file']['filename'] = '/logs/health.log'
-
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
+# Load logging configuration (queue-backed handlers)
+logger = setup_logging('health')
 
 # Datastore file path
 DATASTORE_FILE = app_config['datastore']['filename']
 
+# Dashboard stats are collected once per container and pushed to every viewer
+live_config = app_config['live']
+LIVE_STATS = LiveStatsCollector(live_config, DATASTORE_FILE)
+LIVE_SNAPSHOTS = SnapshotBroadcaster(live_config['filename'], live_config.get('poll_interval', 1),
+                                     LIVE_STATS.subscribers)
+
+# Last lag report per consumer as (monotonic time, committed, high watermark), used for rate estimates
+LAG_SAMPLES = {}
+
 
 def init_datastore():
     """Initialize the datastore with default values"""
@@ -55,18 +60,94 @@ def check_service_health(service_name, url):
         return "Down"
 
 
+def check_consumer_lag(service_name, consumer_config):
+    """Fetch a consumer's lag and estimate how long it needs to catch up.
+
+    Produce and consume rates come from the difference between this report
+    and the previous one. A consumer is Degraded when its lag exceeds
+    max_lag, or when it would need longer than max_catch_up_seconds to
+    reach the head of the topic (never, if it consumes slower than the
+    producers write).
+
+    A consumer that keeps up still trails the head by whatever arrived
+    since its last commit, and its rate matches the producers' give or
+    take noise. So the catch-up test only applies once the lag exceeds what
+    was produced since the previous report; a stalled consumer passes that
+    within two reports.
+    """
+    try:
+        response = requests.get(consumer_config['url'], timeout=5)
+    except requests.RequestException as e:
+        logger.warning(f"Consumer lag for {service_name} unavailable: {e}")
+        return {"status": "Unknown"}
+    if response.status_code != 200:
+        logger.warning(f"Consumer lag for {service_name} unavailable (status {response.status_code})")
+        return {"status": "Unknown"}
+
+    report = response.json()
+    now = time.monotonic()
+    previous = LAG_SAMPLES.get(service_name)
+    LAG_SAMPLES[service_name] = (now, report['committed'], report['high_watermark'])
+
+    lag = report['lag']
+    consume_rate = None
+    produce_rate = None
+    catch_up_seconds = 0 if lag == 0 else None
+    in_flight = None
+    if previous is not None and now > previous[0]:
+        elapsed = now - previous[0]
+        in_flight = report['high_watermark'] - previous[2]
+        consume_rate = (report['committed'] - previous[1]) / elapsed
+        produce_rate = in_flight / elapsed
+        if lag > 0 and consume_rate > produce_rate:
+            catch_up_seconds = lag / (consume_rate - produce_rate)
+
+    status = "Running"
+    max_lag = consumer_config.get('max_lag')
+    max_catch_up = consumer_config.get('max_catch_up_seconds')
+    if max_lag is not None and lag > max_lag:
+        status = "Degraded"
+    # Needs two reports before a rate (and so a catch-up time) can be estimated
+    if max_catch_up is not None and in_flight is not None and lag > max(in_flight, 0):
+        if catch_up_seconds is None or catch_up_seconds > max_catch_up:
+            status = "Degraded"
+    if status == "Degraded":
+        logger.warning(f"Consumer {service_name} is Degraded: lag={lag} catch_up_seconds={catch_up_seconds}")
+
+    return {
+        "status": status,
+        "lag": lag,
+        "committed": report['committed'],
+        "high_watermark": report['high_watermark'],
+        "consume_rate": round(consume_rate, 2) if consume_rate is not None else None,
+        "produce_rate": round(produce_rate, 2) if produce_rate is not None else None,
+        "catch_up_seconds": round(catch_up_seconds, 1) if catch_up_seconds is not None else None,
+        "partitions": report['partitions'],
+    }
+
+
+@JOB_DURATION.labels(job="check_all_services").time()
 def check_all_services():
     """Poll all services and update datastore"""
     logger.info("Checking health of all services")
     
     services = app_config['services']
+    consumers = app_config.get('consumers', {})
     statuses = {}
+    consumer_stats = {}
     
     for service_name, service_config in services.items():
         service_url = service_config['url']
         status = check_service_health(service_name, service_url)
+        # A consumer that answers but has fallen behind the topic is reported as Degraded
+        if status == "Running" and service_name in consumers:
+            consumer_stats[service_name] = check_consumer_lag(service_name, consumers[service_name])
+            if consumer_stats[service_name]['status'] == "Degraded":
+                status = "Degraded"
         statuses[service_name] = status
     
+    statuses['consumers'] = consumer_stats
+
     # Update datastore
     statuses['last_update'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
     
@@ -89,6 +170,21 @@ def get_health_stats():
         return {"message": "Statistics not available"}, 404
 
 
+def get_live_stats():
+    """Latest dashboard stats snapshot (also pushed on /health/live/stream)"""
+    # Keeps the collector running for clients that poll instead of subscribing
+    LIVE_STATS.subscribers.touch()
+    if not os.path.exists(live_config['filename']):
+        return {"message": "Live stats not collected yet"}, 404
+    with open(live_config['filename'], 'r') as f:
+        return json.load(f), 200
+
+
+def metrics():
+    """Prometheus metrics endpoint"""
+    return metrics_response()
+
+
 def init_scheduler():
     """Initialize the background scheduler"""
     sched = BackgroundScheduler(daemon=True)
@@ -97,15 +193,31 @@ def init_scheduler():
         'interval',
         seconds=app_config['scheduler']['period']
     )
+    sched.add_job(
+        LIVE_STATS.run,
+        'interval',
+        seconds=live_config['period']
+    )
     sched.start()
     logger.info(f"Scheduler started - polling every {app_config['scheduler']['period']} seconds")
 
 
+def start_background():
+    """Service polling; run once per container (see common/server.py)"""
+    init_scheduler()
+
+
 # Initialize datastore
 init_datastore()
 
 # Create connexion app
 app = connexion.FlaskApp(__name__, specification_dir='')
+init_metrics(app)
+# Both only change when their scheduler job runs
+init_http_cache(app, {
+    "app.get_health_stats": app_config['scheduler']['period'],
+    "app.get_live_stats": live_config['period'],
+})
 
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
@@ -117,9 +229,13 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_headers=["*"],
     )
 
+# Server-Sent Events, served outside Flask so open dashboards do not hold request threads
+app.add_middleware(LiveStatsStream, position=MiddlewarePosition.BEFORE_ROUTING, path="/health/live/stream",
+                   broadcaster=LIVE_SNAPSHOTS, heartbeat=live_config.get('heartbeat', 15))
+
 app.add_api('openapi.yaml', base_path="/health", strict_validation=True, validate_responses=True)
 
 if __name__ == '__main__':
-    init_scheduler()
+    start_background()
     logger.info("Starting Health Check Service on port 8120")
     app.run(host="0.0.0.0", port=8120)
@@ -0,0 +1,272 @@
+"""Live dashboard stats, pushed to browsers over Server-Sent Events.
+
+The dashboard used to poll processing, the analyzer (whose stats and event
+lookups each replay the whole topic) and health from every open tab. Now one
+producer gathers everything per container and every viewer subscribes to it:
+
+    LiveStatsCollector   scheduler job (runs in one worker per container):
+                         fetches the stats, picks up the newest event of each
+                         type when the analyzer counts change, and writes the
+                         snapshot to live.filename when anything changed,
+                         as long as someone is reading it
+    SnapshotBroadcaster  one per worker process: watches that file and wakes
+                         the worker's subscribers when a new version lands
+    LiveStatsStream      ASGI middleware serving GET <path> as text/event-stream
+
+Each `stats` event carries the snapshot keys that changed since the
+subscriber's previous event. The first event, and any event after a
+subscriber fell behind, carries the whole snapshot:
+
+    id: 42
+    event: stats
+    data: {"analyzer": {...}, "passenger_count_event": {...}}
+
+The stream is served asynchronously rather than through Flask, so open
+dashboards do not hold any of the app's request threads.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger('basicLogger')
+
+
+class LiveStatsCollector:
+    """Builds the snapshot from the sources, fetching them in parallel.
+
+    Each source has its own timeout (the analyzer's replay the whole topic
+    and take seconds) and at most one fetch in flight. collect() publishes
+    whatever fetches have finished and starts the next ones, so a slow
+    source never holds back the others or makes the job overlap itself.
+    Newest events are fetched for the analyzer counts of the previous
+    round. Nothing is fetched while the stream has no subscribers.
+    """
+    def __init__(self, config, health_file):
+        self.sources = config['sources']
+        self.filename = config['filename']
+        self.health_file = health_file
+        self.subscribers = SubscriberHeartbeat(config.get('subscribers_file', self.filename + ".subscribers"),
+                                               config.get('idle_after', 30))
+        self.snapshot = {}
+        self.executor = ThreadPoolExecutor(max_workers=len(self.sources), thread_name_prefix="live-stats")
+        # source -> Future of its fetch in flight (or finished, until collected)
+        self.pending = {}
+        # snapshot key -> analyzer count its newest event was fetched for
+        self.event_counts = {}
+
+    def fetch(self, name, params=None):
+        source = self.sources[name]
+        response = requests.get(source['url'], params=params, timeout=source.get('timeout', 10))
+        response.raise_for_status()
+        return response.json()
+
+    def start_fetch(self, name, params=None):
+        """Starts fetching a source unless a fetch of it is still in flight; True if started"""
+        if name in self.pending:
+            return False
+        self.pending[name] = self.executor.submit(self.fetch, name, params)
+        return True
+
+    def take(self, snapshot, errors, key, name):
+        """Puts a source's finished fetch into the snapshot (or its error into errors)"""
+        future = self.pending.get(name)
+        if future is None or not future.done():
+            return
+        del self.pending[name]
+        try:
+            snapshot[key] = future.result()
+            errors.pop(name, None)
+        except (requests.RequestException, ValueError) as e:
+            errors[name] = str(e)
+
+    def collect(self):
+        """Publishes the finished fetches if anything changed, then starts the next ones"""
+        if not self.subscribers.active():
+            return
+        snapshot = dict(self.snapshot)
+        errors = dict(self.snapshot.get('errors', {}))
+        with open(self.health_file, 'r') as f:
+            snapshot['health'] = json.load(f)
+        for key, source in (("processing", "processing_stats"), ("analyzer", "analyzer_stats")):
+            self.take(snapshot, errors, key, source)
+            self.start_fetch(source)
+        # New sample events only when the analyzer has seen new events
+        analyzer = snapshot.get('analyzer') or {}
+        for key, source, count in (
+                ("passenger_count_event", "passenger_count_event", "num_passenger_readings"),
+                ("wait_time_event", "wait_time_event", "num_wait_time_readings")):
+            self.take(snapshot, errors, key, source)
+            latest = analyzer.get(count)
+            if latest is None or latest == self.event_counts.get(key):
+                continue
+            if not latest:
+                snapshot[key] = None
+                self.event_counts[key] = latest
+            elif self.start_fetch(source, {"index": latest - 1}):
+                self.event_counts[key] = latest
+        snapshot['errors'] = errors
+        if snapshot == self.snapshot:
+            return
+        snapshot['last_update'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+        # Replaced in one step, so readers never see a half-written snapshot
+        os.replace(tmp_file, self.filename)
+        self.snapshot = snapshot
+        logger.debug("Published live stats: %s", snapshot)
+
+    def run(self):
+        try:
+            self.collect()
+        except Exception as e:
+            logger.error(f"Could not collect live stats: {e}")
+
+
+class SubscriberHeartbeat:
+    """File touched by any worker that has live stats readers, so the collector knows it has an audience"""
+    def __init__(self, filename, idle_after=30):
+        self.filename = filename
+        self.idle_after = idle_after
+
+    def touch(self):
+        with open(self.filename, 'a'):
+            os.utime(self.filename)
+
+    def active(self):
+        """True if someone read the stats within the last idle_after seconds"""
+        try:
+            return time.time() - os.stat(self.filename).st_mtime < self.idle_after
+        except FileNotFoundError:
+            return False
+
+
+class SnapshotBroadcaster:
+    """Watches the snapshot file for one worker process and versions what it reads"""
+    def __init__(self, filename, poll_interval=1, heartbeat=None):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        # SubscriberHeartbeat kept fresh while this worker has subscribers
+        self.heartbeat = heartbeat
+        self.subscribers = 0
+        self.version = 0
+        self.snapshot = None
+        self.delta = None
+        self.mtime = None
+        self.changed = None
+
+    def ensure_started(self):
+        # Created on first use, inside the worker's event loop
+        if self.changed is None:
+            self.changed = asyncio.Condition()
+            asyncio.get_running_loop().create_task(self.watch())
+
+    def subscribe(self):
+        self.subscribers += 1
+        if self.heartbeat is not None:
+            self.heartbeat.touch()
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+
+    async def watch(self):
+        while True:
+            try:
+                if self.subscribers and self.heartbeat is not None:
+                    self.heartbeat.touch()
+                self.load()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read live stats snapshot: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def load(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        with open(self.filename, 'r') as f:
+            snapshot = json.load(f)
+        self.mtime = mtime
+        previous = self.snapshot or {}
+        delta = {key: value for key, value in snapshot.items() if previous.get(key) != value}
+        if not delta:
+            return
+        self.snapshot = snapshot
+        self.delta = delta
+        self.version += 1
+        asyncio.get_running_loop().create_task(self.notify())
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def wait(self, version, timeout):
+        """Waits until a version newer than `version` exists; False on timeout"""
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(lambda: self.version != version), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+    def event_since(self, version):
+        """Payload for a subscriber that last saw `version`: the delta, or the whole snapshot"""
+        data = self.delta if version == self.version - 1 else self.snapshot
+        return f"id: {self.version}\nevent: stats\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class LiveStatsStream:
+    """ASGI middleware serving the broadcaster's snapshots as Server-Sent Events on `path`"""
+    def __init__(self, app, path, broadcaster, heartbeat=15):
+        self.app = app
+        self.path = path
+        self.broadcaster = broadcaster
+        self.heartbeat = heartbeat
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        self.broadcaster.ensure_started()
+        self.broadcaster.subscribe()
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.get_running_loop().create_task(watch_disconnect())
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                # Tells the nginx proxy to pass events through instead of buffering them
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        version = 0
+        try:
+            while not disconnected.is_set():
+                if self.broadcaster.version != version:
+                    body = self.broadcaster.event_since(version)
+                    version = self.broadcaster.version
+                elif not await self.broadcaster.wait(version, self.heartbeat):
+                    body = b": keep-alive\n\n"
+                else:
+                    continue
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+        finally:
+            watcher.cancel()
+            self.broadcaster.unsubscribe()
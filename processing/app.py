@@ -4,24 +4,20 @@ from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import httpx
 import yaml
-import logging
-import logging.config
 from apscheduler.schedulers.background import BackgroundScheduler
 import os
 import json
 from datetime import datetime, timezone
+from common.http_cache import init_http_cache
+from common.logs import setup_logging
+from common.metrics import JOB_DURATION, init_metrics, metrics_response
 
 # Load configuration file from shared config mount (per-service folder)
 with open('/config/processing/app_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
-# Load logging configuration and set per-service logfile under /logs
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    if 'handlers' in log_config and 'file' in log_config['handlers']:
-        log_config['handlers']['file']['filename'] = '/logs/processing.log'
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')     
+# Load logging configuration (queue-backed handlers)
+logger = setup_logging('processing')
 
 def get_stats():
     """Return the current statistics object as defined in OpenAPI."""
@@ -45,6 +41,7 @@ def get_stats():
     logger.info("Successfully processed statistics request")
     return resp, 200
 
+@JOB_DURATION.labels(job="populate_stats").time()
 def populate_stats():
     logger.info("Periodic processing has started")
     current_time = datetime.now(timezone.utc).isoformat(timespec="seconds")
@@ -53,7 +50,8 @@ def populate_stats():
     if os.path.isfile(data_file):
         with open(data_file, "r") as file:
             data = json.load(file)
-            params= {'start_timestamp' : data['last_updated'], 'end_timestamp': current_time}
+            # aggregated marks these reads as processing's, for storage's end-to-end trace latency
+            params= {'start_timestamp' : data['last_updated'], 'end_timestamp': current_time, 'aggregated': 'true'}
             passenger_response = httpx.get(app_config['events']['passenger_count']['url'],params=params)
             wait_response = httpx.get(app_config['events']['wait_time']['url'], params=params)
             
@@ -133,11 +131,22 @@ def init_scheduler():
         
     sched.start()
 
+def start_background():
+    """Periodic stats processing; run once per container (see common/server.py)"""
+    init_scheduler()
+
 def health():
     """Health check endpoint"""
     return {"status": "ok"}, 200
 
+def metrics():
+    """Prometheus metrics endpoint"""
+    return metrics_response()
+
 app = connexion.FlaskApp(__name__, specification_dir='') 
+init_metrics(app)
+# Stats only change when populate_stats runs
+init_http_cache(app, {"app.get_stats": app_config['scheduler']['interval']})
 
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
@@ -152,6 +161,6 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
 app.add_api("student-770-NorthAmericanTrainInfo-1.0.0-swagger.yaml", base_path="/processing", strict_validation=True, validate_responses=True) 
 if __name__ == "__main__":
     logger.info("Starting Processing Service on port 8100")
-    init_scheduler()
+    start_background()
     # Bind to 0.0.0.0 so Docker can expose the port outside the container
     app.run(host="0.0.0.0", port=8100)        
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""Benchmark Kafka producer settings against an in-process broker stand-in.
+
+Encodes synthetic receiver messages exactly the way pykafka puts them on the
+wire (MessageSet + optional compression) for every combination of codec and
+batch size, and reports bytes-on-wire and encode throughput for each.
+
+Usage:
+    python kafka_benchmark.py
+    python kafka_benchmark.py --messages 50000 --batch-sizes 1,100,500 --compression none,gzip
+    python kafka_benchmark.py --output /logs/kafka_benchmark.json
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import struct
+import time
+import uuid
+
+import yaml
+from pykafka.common import CompressionType
+from pykafka.protocol import Message, MessageSet
+
+CODECS = {
+    "none": CompressionType.NONE,
+    "gzip": CompressionType.GZIP,
+    "snappy": CompressionType.SNAPPY,
+    "lz4": CompressionType.LZ4,
+}
+
+
+class LocalBroker:
+    """Stand-in for a broker connection: serializes message sets and counts what would be sent"""
+    def __init__(self):
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def send(self, message_set):
+        size = len(message_set)
+        buff = bytearray(4 + size)
+        struct.pack_into('!i', buff, 0, size)
+        message_set.pack_into(buff, 4)
+        self.requests += 1
+        self.bytes_sent += len(buff)
+
+
+def make_messages(count):
+    """Builds receiver-shaped passenger_count / wait_time messages"""
+    station_ids = [str(uuid.uuid4()) for _ in range(20)]
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    messages = []
+    for i in range(count):
+        payload = {
+            "trace_id": time.time_ns() + i,
+            "station_id": random.choice(station_ids),
+            "station_name": "Yellowknife North",
+            "transit_system": "Metro Vancouver",
+            "batch_timestamp": now,
+            "recorded_timestamp": now,
+        }
+        if i % 2:
+            msg_type = "wait_time"
+            payload["current_minutes_wait"] = random.randint(0, 30)
+            payload["active_alerts"] = random.choice(["none", "full", "other"])
+        else:
+            msg_type = "passenger_count"
+            payload["passenger_count"] = random.randint(0, 500)
+        msg = {"type": msg_type, "datetime": now, "payload": payload}
+        messages.append(json.dumps(msg).encode('utf-8'))
+    return messages
+
+
+def codec_available(codec):
+    """Some codecs need optional packages (python-snappy, lz4)"""
+    try:
+        len(MessageSet(compression_type=codec, messages=[Message(b"probe")]))
+        return True
+    except (ImportError, AssertionError):
+        return False
+
+
+def run_setting(messages, compression, batch_size):
+    broker = LocalBroker()
+    codec = CODECS[compression]
+    start = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        batch = [Message(value) for value in messages[i:i + batch_size]]
+        broker.send(MessageSet(compression_type=codec, messages=batch))
+    elapsed = time.perf_counter() - start
+    raw_bytes = sum(len(value) for value in messages)
+    return {
+        "compression": compression,
+        "batch_size": batch_size,
+        "messages": len(messages),
+        "requests": broker.requests,
+        "payload_bytes": raw_bytes,
+        "bytes_on_wire": broker.bytes_sent,
+        "bytes_per_message": round(broker.bytes_sent / len(messages), 1),
+        "ratio": round(broker.bytes_sent / raw_bytes, 3),
+        "seconds": round(elapsed, 4),
+        "messages_per_sec": round(len(messages) / elapsed) if elapsed else None,
+    }
+
+
+def configured_setting(config_path):
+    """Returns (compression, batch_size) from the receiver's events.producer section, if any"""
+    if not os.path.isfile(config_path):
+        return None
+    with open(config_path, 'r') as f:
+        producer = (yaml.safe_load(f.read()).get('events') or {}).get('producer') or {}
+    batch_size = 1 if producer.get('sync', True) else producer.get('min_queued_messages', 70000)
+    return str(producer.get('compression', 'none')).lower(), int(batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Kafka producer compression/batching settings")
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--batch-sizes', default="1,50,200,500,1000")
+    parser.add_argument('--compression', default=",".join(CODECS))
+    parser.add_argument('--config', default='/config/receiver/app_conf.yml')
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    batch_sizes = sorted({int(b) for b in args.batch_sizes.split(",")})
+    settings = [(c.strip().lower(), b) for c in args.compression.split(",") for b in batch_sizes]
+    current = configured_setting(args.config)
+    if current and current not in settings:
+        settings.append(current)
+
+    for compression in sorted({c for c, _ in settings}):
+        if compression not in CODECS:
+            print(f"Skipping unknown codec {compression}")
+        elif not codec_available(CODECS[compression]):
+            print(f"Skipping {compression}: codec library not installed")
+    usable = {c for c in CODECS if codec_available(CODECS[c])}
+
+    messages = make_messages(args.messages)
+    results = []
+    for compression, batch_size in settings:
+        if compression not in usable:
+            continue
+        result = run_setting(messages, compression, batch_size)
+        result["configured"] = (compression, batch_size) == current
+        results.append(result)
+
+    print(f"{'compression':<12}{'batch':>7}{'requests':>10}{'bytes/msg':>11}{'ratio':>8}{'msgs/sec':>12}")
+    for r in results:
+        marker = "  <- app_conf.yml" if r["configured"] else ""
+        print(f"{r['compression']:<12}{r['batch_size']:>7}{r['requests']:>10}{r['bytes_per_message']:>11}"
+              f"{r['ratio']:>8}{r['messages_per_sec']:>12}{marker}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
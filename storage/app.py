@@ -5,22 +5,34 @@ from starlette.middleware.cors import CORSMiddleware
 import functools
 import os
 import yaml
-import logging
-import logging.config
 import json
 import datetime
 import time
-import random
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
-from pykafka.exceptions import KafkaException
 import threading
 from datetime import datetime as dt
 from datetime import date, timezone
+from flask import Response
 
 from event_models import PassengerCountEvent, WaitTimeEvent  
-from sqlalchemy import create_engine, select  
+from archive import ColdArchive
+from export import FORMATS, TableExport
+from partitions import PartitionManager
+from read_db import ReadPool
+from retry_queue import HandoffError, RetryQueue
+from schema import table_problems
+from window_cache import WindowCache
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError, TimeoutError
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.orm import sessionmaker 
+from common.event_bus import make_consumer, make_lag_reader, retry_sleep
+from common.http_cache import init_http_cache
+from common.logs import event_sampler, setup_logging
+from common.metrics import (DB_COMMIT_DURATION, DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_WAIT, DB_SESSION_DURATION,
+                            CONSUMER_BATCH_SIZE, JOB_DURATION, KAFKA_CONSUME_LATENCY, KAFKA_MESSAGES, init_metrics,
+                            metrics_response)
+from common.tracing import SharedTraceRecorder, stamp
  
 # Seems like the datetime information does not get parsed correctly without this
 from dateutil import parser
@@ -29,15 +41,9 @@ from dateutil import parser
 with open('/config/storage/app_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
-# Load logging configuration and set per-service logfile under /logs
-with open('/config/log_conf.yml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    if 'handlers' in log_config and 'file' in log_config['handlers']:
-        log_config['handlers']['file']['filename'] = '/logs/storage.log'
-logging.config.dictConfig(log_config)
-
-# Create logger
-logger = logging.getLogger('basicLogger')
+# Load logging configuration (queue-backed handlers, sampled per-event logs)
+logger = setup_logging('storage')
+sampler = event_sampler(logger)
 
 # Create MySQL database engine using configuration with connection pooling
 db_config = app_config['datastore']
@@ -50,6 +56,34 @@ ENGINE = create_engine(
     pool_pre_ping=True         # Test connections before using them to catch stale/closed connections
 )
 SessionLocal = sessionmaker(bind=ENGINE)  
+# Set explicitly: callback gauges are not exported by the multi-worker server's metrics
+event.listen(ENGINE, "checkout", lambda *args: DB_POOL_CHECKED_OUT.inc())
+event.listen(ENGINE, "checkin", lambda *args: DB_POOL_CHECKED_OUT.dec())
+# A forked server worker must not reuse the parent's pooled connections
+os.register_at_fork(after_in_child=lambda: ENGINE.dispose(close=False))
+
+# Query endpoints read through a separate pool, so they cannot starve the consumer's writes
+READER = ReadPool(db_url, db_config.get('reads', {}))
+os.register_at_fork(after_in_child=lambda: READER.engine.dispose(close=False))
+
+# Expired partitions move to Parquet files on /data; range queries read both
+partition_config = app_config.get('partitions', {})
+ARCHIVE = ColdArchive(partition_config.get('archive_dir', '/data/storage/archive'))
+PARTITIONS = PartitionManager(ENGINE, [PassengerCountEvent.__table__, WaitTimeEvent.__table__], ARCHIVE,
+                              partition_config)
+
+# Serialized results of range queries over closed windows, which can no longer change
+cache_config = app_config.get('cache', {})
+READINGS_CACHE = WindowCache('readings', cache_config.get('max_bytes', 64 * 1024 * 1024),
+                             cache_config.get('closed_after_seconds', 60))
+
+# Reads event_group's committed offsets from the broker, so any server worker can answer /events/lag
+LAG_READER = make_lag_reader(app_config['events'], 'event_group')
+
+# Stage timestamps of recently stored events, for /trace/latency
+tracing_config = app_config.get('tracing', {})
+TRACES = SharedTraceRecorder('storage', tracing_config.get('max_events', 10000),
+                             tracing_config.get('publish_interval', 5))
 
 def make_session():
     #Creates a new database session
@@ -59,38 +93,88 @@ def use_db_session(func):
     #create decorator to handle db sessions automatically. This is given in the lab instructions
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        session = make_session()
-        try:
-            return func(session, *args, **kwargs)
-        finally:
-            session.close()
+        with DB_SESSION_DURATION.labels(function=func.__name__).time():
+            session = make_session()
+            try:
+                # Check a connection out up front so pool waits are measured on their own
+                with DB_POOL_CHECKOUT_WAIT.time():
+                    session.connection()
+                return func(session, *args, **kwargs)
+            finally:
+                session.close()
     return wrapper
 
-@use_db_session
-def report_count_reading(session, body):
-    trace_id = body.get("trace_id")
-    event = PassengerCountEvent(
-        trace_id=trace_id,
-        station_id=body.get("station_id"),
-        station_name=body.get("station_name"),
-        transit_system=body.get("transit_system"),
-        average=body.get("passenger_count"),
-        num_values=1,
-        batch_timestamp=parser.isoparse(body.get("batch_timestamp")),
-        date_created=None,
-    )
-    session.add(event)
-    session.commit()
-    
-    # Log after successful storage
-    logger.debug(f"Stored event passenger_count with a trace id of {trace_id}")
-    
-    return NoContent, 201 
+def passenger_count_row(body):
+    """Column values for one passenger_count reading"""
+    return {
+        "trace_id": body.get("trace_id"),
+        "station_id": body.get("station_id"),
+        "station_name": body.get("station_name"),
+        "transit_system": body.get("transit_system"),
+        "average": body.get("passenger_count"),
+        "num_values": 1,
+        "batch_timestamp": parser.isoparse(body.get("batch_timestamp")),
+    }
+
+def wait_time_row(body):
+    """Column values for one wait_time reading"""
+    return {
+        "trace_id": body.get("trace_id"),
+        "station_id": body.get("station_id"),
+        "station_name": body.get("station_name"),
+        "transit_system": body.get("transit_system"),
+        "average": body.get("current_minutes_wait"),
+        "num_values": 1,
+        "batch_timestamp": parser.isoparse(body.get("batch_timestamp")),
+    }
+
+# Message type (including the old event1/event2 names) -> table and row builder
+EVENT_TABLES = {
+    "passenger_count": (PassengerCountEvent, passenger_count_row),
+    "event1": (PassengerCountEvent, passenger_count_row),
+    "wait_time": (WaitTimeEvent, wait_time_row),
+    "event2": (WaitTimeEvent, wait_time_row),
+}
 
 @use_db_session
-def get_passenger_count_readings(session,start_timestamp, end_timestamp):
-    """ Gets new passenger_count readings between the start and end timestamps """
+def store_rows(session, rows_by_model):
+    """Bulk-inserts rows for each table in one transaction, skipping trace_ids that are already stored.
+
+    trace_id is unique per table, so ON DUPLICATE KEY UPDATE with a no-op
+    assignment turns re-delivered events into no-ops instead of duplicates.
+    """
+    for model, rows in rows_by_model.items():
+        statement = insert(model)
+        statement = statement.on_duplicate_key_update(trace_id=statement.inserted.trace_id)
+        session.execute(statement, rows)
+    tables = ",".join(sorted(model.__tablename__ for model in rows_by_model))
+    with DB_COMMIT_DURATION.labels(table=tables).time():
+        session.commit()
+    logger.debug("Stored %d rows into %s", sum(len(rows) for rows in rows_by_model.values()), tables)
+
+def merge_archived(model, results, start, end):
+    """Prepends archived rows in the window to the live ones.
+
+    A partition's archive file is written before the partition is dropped,
+    so a row can briefly exist in both; the live copy wins.
+    """
+    live = {r["trace_id"] for r in results}
+    archived = [r for r in ARCHIVE.query(model.__table__, start, end) if r["trace_id"] not in live]
+    return archived + results
+
+@JOB_DURATION.labels(job="maintain_partitions").time()
+def maintain_partitions():
+    """Adds upcoming partitions and archives or drops the expired ones"""
+    try:
+        PARTITIONS.maintain()
+    except Exception as e:
+        logger.error(f"Partition maintenance failed: {e}")
+    if PARTITIONS.expired == 'drop':
+        # Dropped partitions take their rows out of windows that were cached as final
+        READINGS_CACHE.invalidate()
 
+def parse_window(start_timestamp, end_timestamp):
+    """Parses a query window into naive UTC datetimes"""
     # Use dateutil to support ISO-8601 with 'Z' suffix and various precisions
     start = parser.isoparse(start_timestamp)
     end = parser.isoparse(end_timestamp)
@@ -99,60 +183,118 @@ def get_passenger_count_readings(session,start_timestamp, end_timestamp):
         start = start.astimezone(timezone.utc).replace(tzinfo=None)
     if end.tzinfo is not None:
         end = end.astimezone(timezone.utc).replace(tzinfo=None)
+    return start, end
 
-    statement = select(PassengerCountEvent).where(PassengerCountEvent.date_created >= start).where(PassengerCountEvent.date_created < end)
-    results = [result.to_dict()
-        for result in session.execute(statement).scalars().all()
-        ]
-    logger.debug("Found %d PassengerCountEvent readings (start: %s, end: %s)", len(results), start, end)
+def query_readings(model, start, end):
+    """Live and archived rows of one event table created between start and end"""
+    with DB_SESSION_DURATION.labels(function="query_readings").time():
+        results = READER.readings(model, start, end)
+    results = merge_archived(model, results, start, end)
+    logger.debug("Found %d %s readings (start: %s, end: %s)", len(results), model.__name__, start, end)
     return results
 
-@use_db_session
-def report_wait_time_reading(session, body):
-    trace_id = body.get("trace_id")
-    #Store wait time reading in the database
-    event = WaitTimeEvent(
-        trace_id=trace_id,
-        station_id=body.get("station_id"),
-        station_name=body.get("station_name"),
-        transit_system=body.get("transit_system"),
-        average=body.get("current_minutes_wait"),
-        num_values=1,
-        batch_timestamp=parser.isoparse(body.get("batch_timestamp")),
-        date_created=None
-    )
-    session.add(event)  
-    session.commit()
-    
-    # Log after successful storage
-    logger.debug(f"Stored event wait_time with a trace id of {trace_id}")
-    
-    return NoContent, 201  
+def closed_window_cache_control():
+    """Cache-Control of a closed window: immutable, unless maintenance may still drop its rows"""
+    max_age = http_cache_config.get('closed_max_age', 86400)
+    if PARTITIONS.expired == 'archive':
+        return f"public, max-age={max_age}, immutable"
+    # Dropped partitions change closed windows, so proxies and browsers must not keep them past a maintenance run
+    return f"public, max-age={min(max_age, partition_config.get('maintenance_interval', 3600))}"
 
-@use_db_session
-def get_wait_time_reading(session,start_timestamp, end_timestamp):
+def get_readings(model, start_timestamp, end_timestamp, aggregated=False):
+    """JSON response with the readings in the window, served from READINGS_CACHE once the window is closed.
+
+    Only processing passes aggregated=True; other readers (dashboards, load
+    tests) must not stamp the traces of what they read.
+    """
+    start, end = parse_window(start_timestamp, end_timestamp)
+    try:
+        body = READINGS_CACHE.get((model.__tablename__, start, end, ()), end,
+                                  lambda: json.dumps(query_readings(model, start, end)).encode('utf-8'))
+    except (TimeoutError, OperationalError) as e:
+        # Read pool exhausted, statement timeout hit, or the database is unreachable
+        logger.warning(f"Could not read {model.__tablename__}: {e}")
+        return {"message": "Query timed out or the database is unavailable"}, 503
+    if aggregated:
+        TRACES.mark([r["trace_id"] for r in json.loads(body)], "aggregated")
+    headers = {}
+    if READINGS_CACHE.closed(end):
+        headers["Cache-Control"] = closed_window_cache_control()
+    return Response(body, status=200, mimetype="application/json", headers=headers)
+
+def get_passenger_count_readings(start_timestamp, end_timestamp, aggregated=False):
+    """ Gets new passenger_count readings between the start and end timestamps """
+    return get_readings(PassengerCountEvent, start_timestamp, end_timestamp, aggregated)
+
+def get_wait_time_reading(start_timestamp, end_timestamp, aggregated=False):
     """ Gets new wait_time readings between the start and end timestamps """
+    return get_readings(WaitTimeEvent, start_timestamp, end_timestamp, aggregated)
 
-    # Use dateutil to support ISO-8601 with 'Z' suffix and various precisions
-    start = parser.isoparse(start_timestamp)
-    end = parser.isoparse(end_timestamp)
-    # Normalize to naive UTC to match DB timestamps (MySQL container typically stores NOW() in UTC)
-    if start.tzinfo is not None:
-        start = start.astimezone(timezone.utc).replace(tzinfo=None)
-    if end.tzinfo is not None:
-        end = end.astimezone(timezone.utc).replace(tzinfo=None)
-    statement = select(WaitTimeEvent).where(WaitTimeEvent.date_created >= start).where(WaitTimeEvent.date_created < end)
-    results = [result.to_dict()
-        for result in session.execute(statement).scalars().all()
-        ]
-    logger.debug("Found %d WaitTimeEvent readings (start: %s, end: %s)", len(results), start, end)
-    return results
+# Tables that can be exported in bulk by /export/{event_type}
+EXPORT_TABLES = {
+    "passenger_count": PassengerCountEvent.__table__,
+    "wait_time": WaitTimeEvent.__table__,
+}
+
+def export_events(event_type, start_timestamp, end_timestamp, format="csv"):
+    """Streams every event of one type in the window as gzipped CSV, Arrow IPC or Parquet.
+
+    Rows go from a server-side cursor to the response one chunk at a time,
+    without ORM objects or per-row dicts, so the window size is not bounded
+    by memory the way the JSON readings endpoints are.
+    """
+    start, end = parse_window(start_timestamp, end_timestamp)
+    export_config = app_config.get('export', {})
+    export = TableExport(READER, ARCHIVE, EXPORT_TABLES[event_type], start, end,
+                         export_config.get('chunk_rows', 10000), export_config.get('max_seconds', 600))
+    try:
+        chunks = export.stream(format, export_config.get('gzip_level', 6))
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    content_type, extension = FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="{event_type}_{start:%Y%m%dT%H%M%S}.{extension}"'}
+    logger.info("Exporting %s between %s and %s as %s", event_type, start, end, format)
+    return Response(chunks, status=200, mimetype=content_type, headers=headers)
+
+def get_trace_latency(type=None):
+    """End-to-end and per-hop latency percentiles (ms) over recently stored events"""
+    return TRACES.summary(type), 200
+
+def get_consumer_lag():
+    """Committed offset vs. high watermark per partition for the event_group consumer"""
+    try:
+        return LAG_READER.lag(), 200
+    except Exception as e:
+        logger.warning(f"Could not fetch consumer lag: {e}")
+        return {"message": "Consumer lag unavailable"}, 503
+
+def replay_dead_letters(limit=None):
+    """Moves dead-lettered messages back onto the first retry tier"""
+    try:
+        replayed = RETRIES.replay_dead_letters(limit)
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    return {"replayed": replayed}, 200
 
 def health():
     """Health check endpoint"""
     return {"status": "ok"}, 200
 
+def metrics():
+    """Prometheus metrics endpoint"""
+    return metrics_response()
+
 app = connexion.FlaskApp(__name__, specification_dir='')  
+init_metrics(app)
+# Closed windows are immutable (get_readings); everything else is reusable for http_cache.max_age seconds
+http_cache_config = app_config.get('http_cache', {})
+storage_max_age = http_cache_config.get('max_age', 5)
+init_http_cache(app, {
+    "app.get_passenger_count_readings": storage_max_age,
+    "app.get_wait_time_reading": storage_max_age,
+    "app.get_consumer_lag": storage_max_age,
+    "app.get_trace_latency": storage_max_age,
+})
 
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
@@ -167,114 +309,190 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
 app.add_api("student-770-NorthAmericanTrainInfo-1.0.0-swagger.yaml", base_path="/storage", strict_validation=True, validate_responses=True)  # Add OpenAPI spec
 
 
-class KafkaConsumerWrapper:
-    """Kafka consumer wrapper with retry logic for storage service"""
-    def __init__(self, hostname, topic):
-        self.hostname = hostname
-        self.topic = topic
-        self.client = None
-        self.consumer = None
-        self.connect()
-    
-    def connect(self):
-        """Infinite loop: will keep trying until connected"""
-        while True:
-            logger.debug("Trying to connect to Kafka...")
-            if self.make_client():
-                if self.make_consumer():
-                    break
-            # Sleep for random amount of time (0.5 to 1.5s)
-            time.sleep(random.randint(500, 1500) / 1000)
-    
-    def make_client(self):
-        """Creates Kafka client. Returns True on success, False on failure"""
-        if self.client is not None:
-            return True
-        try:
-            self.client = KafkaClient(hosts=self.hostname)
-            logger.info("Kafka client created!")
-            return True
-        except KafkaException as e:
-            logger.warning(f"Kafka error when making client: {e}")
-            self.client = None
-            self.consumer = None
-            return False
-    
-    def make_consumer(self):
-        """Creates Kafka consumer. Returns True on success, False on failure"""
-        if self.consumer is not None:
-            return True
-        if self.client is None:
-            return False
-        try:
-            topic = self.client.topics[str.encode(self.topic)]
-            self.consumer = topic.get_simple_consumer(
-                consumer_group=b'event_group',
-                reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
-            )
-            logger.info(f"Kafka consumer created for topic {self.topic}")
-            return True
-        except KafkaException as e:
-            logger.warning(f"Kafka error when making consumer: {e}")
-            self.client = None
-            self.consumer = None
-            return False
-    
-    def messages(self):
-        """Generator method that catches exceptions in the consumer loop"""
-        if self.consumer is None:
-            self.connect()
-        while True:
+def record_stored(messages):
+    """Stamps stored messages as committed and records their traces"""
+    committed = time.time_ns()
+    for msg_obj in messages:
+        stamp(msg_obj, "committed", committed)
+        TRACES.record((msg_obj.get('payload') or {}).get('trace_id'), msg_obj.get('type'), msg_obj["stages"])
+
+def store_message(msg_obj):
+    """Stores one decoded event and records its trace; raises if it cannot be stored"""
+    table = EVENT_TABLES.get(msg_obj.get('type'))
+    if table is not None:
+        model, build_row = table
+        store_rows({model: [build_row(msg_obj.get('payload'))]})
+    record_stored([msg_obj])
+
+
+# Failed messages go through the retry tiers and dead-letter topic instead of stalling the consumer
+RETRIES = RetryQueue(app_config['events'], store_message, consumer_group='event_group')
+
+
+def store_batch(messages):
+    """Stores a batch of decoded events in one transaction; returns how many were stored.
+
+    Messages whose row cannot be built go to the retry tiers on their own.
+    If the bulk write fails, each message is stored separately so one bad
+    row only sends itself to the retry tiers. Raises HandoffError if a
+    failed message cannot be handed to them.
+    """
+    rows_by_model = {}
+    batch = []
+    for msg_obj in messages:
+        table = EVENT_TABLES.get(msg_obj.get('type'))
+        if table is not None:
+            model, build_row = table
             try:
-                for msg in self.consumer:
-                    yield msg
-            except KafkaException as e:
-                logger.warning(f"Kafka issue in consumer: {e}")
-                self.client = None
-                self.consumer = None
-                self.connect()
+                rows_by_model.setdefault(model, []).append(build_row(msg_obj.get('payload')))
+            except Exception as e:
+                logger.error(f"Error processing message: {e}")
+                RETRIES.fail(msg_obj, e)
+                continue
+        batch.append(msg_obj)
 
+    try:
+        if rows_by_model:
+            store_rows(rows_by_model)
+        record_stored(batch)
+        return len(batch)
+    except Exception as e:
+        logger.error(f"Bulk write of {len(batch)} messages failed ({e}); storing them one at a time")
 
-def process_messages():
-    """Process event messages from Kafka and store them in the DB."""
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    logger.info("Kafka consumer loop starting; target broker=%s topic=%s",
-                hostname, app_config['events']['topic'])
-    
-    # Create global Kafka consumer wrapper (handles reconnection automatically)
-    kafka_wrapper = KafkaConsumerWrapper(hostname, app_config['events']['topic'])
-    
-    for msg in kafka_wrapper.messages():
-        if msg is None:
-            continue
+    stored = 0
+    for msg_obj in batch:
         try:
-            msg_str = msg.value.decode('utf-8')
-            msg_obj = json.loads(msg_str)
-            logger.info("Message: %s", msg_obj)
-            payload = msg_obj.get('payload')
-            mtype = msg_obj.get('type')
-
-            # Dispatch based on message type
-            if mtype == 'passenger_count' or mtype == 'event1':
-                report_count_reading(payload)
-            elif mtype == 'wait_time' or mtype == 'event2':
-                report_wait_time_reading(payload)
-
-            # commit that we've processed this message
-            kafka_wrapper.consumer.commit_offsets()
-            logger.info(f"Connected to Kafka")
+            store_message(msg_obj)
+            stored += 1
         except Exception as e:
             logger.error(f"Error processing message: {e}")
+            RETRIES.fail(msg_obj, e)
+    return stored
+
+
+def process_messages():
+    """Process event messages from the event bus and store them in the DB.
+
+    Messages are written in batches of up to events.batch.max_messages, or
+    whatever arrived within events.batch.max_wait_ms, and offsets are only
+    committed after their batch is stored (or handed to the retry tiers).
+    Rows are unique per trace_id, so messages re-delivered after a crash
+    between the DB commit and the offset commit are skipped, not duplicated.
+    If a failed message cannot be handed to the retry tiers, nothing past
+    the last commit is committed: the consumer goes back to it and reads
+    the batch again.
+    """
+    topic = app_config['events']['topic']
+    batch_config = app_config['events'].get('batch', {})
+    max_messages = batch_config.get('max_messages', 500)
+    max_wait_ms = batch_config.get('max_wait_ms', 200)
+    logger.info("Event consumer loop starting; backend=%s topic=%s batch=%d/%dms",
+                app_config['events'].get('backend', 'kafka'), topic, max_messages, max_wait_ms)
+    
+    # Consumer handles reconnection automatically; messages() returns after max_wait_ms without a message
+    consumer = make_consumer(app_config['events'], consumer_group='event_group', timeout_ms=max_wait_ms)
+
+    batch = []
+    read = 0            # messages read since the last offset commit
+    batch_started = 0
+
+    def flush():
+        stored = store_batch(batch) if batch else 0
+        # commit that we've processed (or handed off) everything read so far
+        consumer.commit()
+        CONSUMER_BATCH_SIZE.observe(read)
+        KAFKA_MESSAGES.labels(topic=topic, direction="consumed", outcome="ok").inc(stored)
+        KAFKA_MESSAGES.labels(topic=topic, direction="consumed", outcome="failed").inc(read - stored)
+
+    while True:
+        try:
+            for msg in consumer.messages():
+                start = time.perf_counter()
+                if read == 0:
+                    batch_started = time.monotonic()
+                read += 1
+                try:
+                    msg_str = msg.value.decode('utf-8')
+                    msg_obj = json.loads(msg_str)
+                    stamp(msg_obj, "consumed")
+                    sampler.info("storage.message", "Message: %s", msg_obj)
+                    batch.append(msg_obj)
+                except ValueError as e:
+                    logger.error(f"Undecodable message at offset {msg.offset}: {e}")
+                    RETRIES.fail_undecodable(msg.value, e)
+                KAFKA_CONSUME_LATENCY.labels(topic=topic).observe(time.perf_counter() - start)
 
+                if read >= max_messages or time.monotonic() - batch_started >= max_wait_ms / 1000:
+                    flush()
+                    batch = []
+                    read = 0
+            # The topic went quiet: write out whatever is buffered
+            if read:
+                flush()
+                batch = []
+                read = 0
+        except HandoffError as e:
+            logger.error(f"{e}; re-reading from the last committed offset")
+            consumer.restart()
+            batch = []
+            read = 0
+            retry_sleep()
+
+
+def check_schema():
+    """Waits until the event tables exist; raises RuntimeError if one still has to be migrated.
+
+    Consuming into a table without its unique trace_id key would silently
+    insert re-delivered events again, so storage refuses to.
+    """
+    tables = PARTITIONS.tables
+    while True:
+        try:
+            with ENGINE.connect() as conn:
+                problems = {table.name: table_problems(conn, table) for table in tables}
+        except OperationalError as e:
+            logger.warning(f"Cannot check the event tables yet: {e}")
+        else:
+            missing = [name for name, found in problems.items() if found is None]
+            if not missing:
+                break
+            logger.warning("Waiting for create_tables.py to create %s", ", ".join(missing))
+        time.sleep(5)
+    outdated = {name: found for name, found in problems.items() if found}
+    for name, found in outdated.items():
+        logger.critical("%s is out of date (%s); run migrate_tables.py", name, "; ".join(found))
+    if outdated:
+        raise RuntimeError(f"Not consuming events until migrate_tables.py has updated {', '.join(outdated)}")
+
+def consume_events():
+    """Starts the retry tiers and the consumer loop once the event tables are usable"""
+    check_schema()
+    RETRIES.start()
+    process_messages()
 
 def setup_kafka_thread():
-    t1 = threading.Thread(target=process_messages)
+    t1 = threading.Thread(target=consume_events)
     t1.daemon = True  # setDaemon is deprecated
-    logger.info("Launching Kafka consumer background thread")
+    logger.info("Launching event consumer background thread")
     t1.start()
 
-if __name__ == "__main__":
+def init_scheduler():
+    sched = BackgroundScheduler(daemon=True)
+    # Run once at startup so today's partitions exist before the first insert
+    sched.add_job(maintain_partitions,
+        'interval',
+        seconds=partition_config.get('maintenance_interval', 3600),
+        next_run_time=dt.now())
+    sched.start()
+
+def start_background():
+    """Partition maintenance, the event consumer and the retry tiers; run once per container"""
+    # The consumer records the traces, so this worker keeps them and publishes their summaries
+    TRACES.own()
+    init_scheduler()
     setup_kafka_thread()
+
+if __name__ == "__main__":
+    start_background()
     # Bind to 0.0.0.0 so Docker can expose the port outside the container
     app.run(host="0.0.0.0", port=8090)  
\ No newline at end of file
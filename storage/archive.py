@@ -0,0 +1,165 @@
+"""Cold archive of expired event partitions, stored as Parquet files.
+
+When PartitionManager retires a partition it streams the rows into
+
+    <directory>/<table>/<partition>.parquet
+
+(zstd-compressed, columnar, one row group per chunk) and only then drops
+the partition from MySQL. Range queries call ColdArchive.query() and merge
+the result with the live table, so clients keep seeing the full history.
+
+Every file's date_created range is read from the Parquet footer statistics
+once and kept in memory. A query only opens files that overlap its window,
+and inside those files pyarrow skips row groups using the same statistics.
+The index is refreshed whenever a table's directory changes, so server
+workers also see partitions archived by the worker running maintenance.
+
+pyarrow is optional: without it partitions are kept in MySQL (archiving is
+refused) and queries only return live rows.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from sqlalchemy import BigInteger, DateTime, Float, Integer, String
+
+logger = logging.getLogger('basicLogger')
+
+
+def arrow_schema(table):
+    """Arrow schema matching a SQLAlchemy table's columns"""
+    types = [
+        (BigInteger, pa.int64()),
+        (Integer, pa.int64()),
+        (Float, pa.float64()),
+        (DateTime, pa.timestamp("us")),
+        (String, pa.string()),
+    ]
+    fields = []
+    for column in table.columns:
+        arrow_type = next(t for sql_type, t in types if isinstance(column.type, sql_type))
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+class ColdArchive:
+    def __init__(self, directory, compression="zstd"):
+        self.directory = directory
+        self.compression = compression
+        self.lock = threading.Lock()
+        # table name -> {path: (min date_created, max date_created)}
+        self.index = {}
+        # table name -> mtime (ns) of its directory when it was last scanned
+        self.scanned = {}
+        if pq is None:
+            logger.warning("pyarrow is not installed; partitions will not be archived and queries only read MySQL")
+
+    @property
+    def available(self):
+        return pq is not None
+
+    def refresh(self, table_name):
+        """Indexes files added to a table's directory (by any process) and forgets removed ones"""
+        table_dir = os.path.join(self.directory, table_name)
+        try:
+            mtime = os.stat(table_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+        # A directory changed within the last second is rescanned every time: a
+        # second change can land in the same timestamp tick and leave mtime as is
+        if self.scanned.get(table_name) == mtime and time.time_ns() - mtime > 10**9:
+            return
+        paths = {os.path.join(table_dir, filename) for filename in os.listdir(table_dir)
+                 if filename.endswith(".parquet")}
+        with self.lock:
+            files = self.index.setdefault(table_name, {})
+            for path in set(files) - paths:
+                del files[path]
+            new_paths = paths - set(files)
+        for path in sorted(new_paths):
+            self.index_file(table_name, path)
+        self.scanned[table_name] = mtime
+
+    def index_file(self, table_name, path):
+        """Records the date_created range of an archived file from its footer statistics"""
+        metadata = pq.ParquetFile(path).metadata
+        column = metadata.schema.to_arrow_schema().get_field_index("date_created")
+        lows = []
+        highs = []
+        for i in range(metadata.num_row_groups):
+            stats = metadata.row_group(i).column(column).statistics
+            if stats is not None and stats.has_min_max:
+                lows.append(stats.min)
+                highs.append(stats.max)
+        with self.lock:
+            files = self.index.setdefault(table_name, {})
+            if lows:
+                files[path] = (min(lows), max(highs))
+            else:
+                files.pop(path, None)
+
+    def write_partition(self, table, partition, chunks):
+        """Writes the rows of one partition (an iterable of row-tuple lists) to Parquet.
+
+        The file is written under a temporary name and renamed into place, so a
+        crash never leaves a half-written archive behind. Returns the row count.
+        """
+        if pq is None:
+            raise RuntimeError("pyarrow is required to archive partitions")
+        table_dir = os.path.join(self.directory, table.name)
+        os.makedirs(table_dir, exist_ok=True)
+        path = os.path.join(table_dir, f"{partition}.parquet")
+        tmp_path = path + ".tmp"
+        schema = arrow_schema(table)
+        rows = 0
+        with pq.ParquetWriter(tmp_path, schema, compression=self.compression) as writer:
+            for chunk in chunks:
+                columns = list(zip(*chunk))
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+                rows += len(chunk)
+        if rows == 0:
+            os.remove(tmp_path)
+            return 0
+        os.replace(tmp_path, path)
+        self.index_file(table.name, path)
+        logger.info("Archived %d rows of %s partition %s to %s", rows, table.name, partition, path)
+        return rows
+
+    def files(self, table, start, end):
+        """Archived files of a table that may hold rows with start <= date_created < end, oldest first"""
+        self.refresh(table.name)
+        with self.lock:
+            return sorted(path for path, (low, high) in self.index.get(table.name, {}).items()
+                          if high >= start and low < end)
+
+    def batches(self, table, start, end, chunk_rows):
+        """Archived rows with start <= date_created < end as Arrow record batches, for bulk export"""
+        if pq is None:
+            return
+        for path in self.files(table, start, end):
+            rows = pq.read_table(path, filters=[("date_created", ">=", start), ("date_created", "<", end)])
+            yield from rows.to_batches(max_chunksize=chunk_rows)
+
+    def query(self, table, start, end):
+        """Archived rows with start <= date_created < end, shaped like the models' to_dict()"""
+        if pq is None:
+            return []
+        results = []
+        for path in self.files(table, start, end):
+            rows = pq.read_table(path, filters=[("date_created", ">=", start), ("date_created", "<", end)])
+            for row in rows.to_pylist():
+                for key, value in row.items():
+                    if isinstance(value, datetime.datetime):
+                        row[key] = value.isoformat()
+                results.append(row)
+        return results
@@ -1,20 +1,33 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, String, Float, DateTime, BigInteger, func
+from sqlalchemy import Integer, String, Float, DateTime, BigInteger, UniqueConstraint, func
+
+from common.tracing import LEGACY_TRACE_ID_MIN
 
 class Base(DeclarativeBase):
     pass
 
+# Tables are range-partitioned on trace_id, which is time-ordered (see common/tracing.py).
+# They start with a catch-all partition; storage's PartitionManager splits
+# day/month partitions off it ahead of time and archives or drops expired ones.
+# Legacy epoch-ns trace_ids sort after every new one and get a partition of their own.
+# MySQL needs the partitioning column in every unique key, hence the (id, trace_id) primary key.
+PARTITION_BY = (f"RANGE (trace_id) (PARTITION p_future VALUES LESS THAN ({LEGACY_TRACE_ID_MIN}), "
+                "PARTITION p_legacy VALUES LESS THAN MAXVALUE)")
+
 class PassengerCountEvent(Base):
     __tablename__ = "passenger_count_event"
-    id = mapped_column(Integer, primary_key=True)
-    trace_id = mapped_column(BigInteger, nullable=False)
+    # One row per trace_id, so re-delivered events can be inserted again without duplicating
+    __table_args__ = (UniqueConstraint("trace_id", name="uq_passenger_count_event_trace_id"),
+                      {"mysql_partition_by": PARTITION_BY})
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    trace_id = mapped_column(BigInteger, primary_key=True)
     station_id = mapped_column(String(250), nullable=False)
     station_name = mapped_column(String(250), nullable=False)
     transit_system = mapped_column(String(250), nullable=True)
     average = mapped_column(Float, nullable=False)
     num_values = mapped_column(Integer, nullable=False)
     batch_timestamp = mapped_column(DateTime, nullable=False)
-    date_created = mapped_column(DateTime, nullable=False, default=func.now())
+    date_created = mapped_column(DateTime, nullable=False, default=func.now(), index=True)
 
     def to_dict(self):
         return {
@@ -36,15 +49,17 @@ class PassengerCountEvent(Base):
 
 class WaitTimeEvent(Base):
     __tablename__ = "wait_time_event"
-    id = mapped_column(Integer, primary_key=True)
-    trace_id = mapped_column(BigInteger, nullable=False)
+    __table_args__ = (UniqueConstraint("trace_id", name="uq_wait_time_event_trace_id"),
+                      {"mysql_partition_by": PARTITION_BY})
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    trace_id = mapped_column(BigInteger, primary_key=True)
     station_id = mapped_column(String(250), nullable=False)
     station_name = mapped_column(String(250), nullable=False)
     transit_system = mapped_column(String(250), nullable=True)
     average = mapped_column(Float, nullable=False)
     num_values = mapped_column(Integer, nullable=False)
     batch_timestamp = mapped_column(DateTime, nullable=False)
-    date_created = mapped_column(DateTime, nullable=False, default=func.now())
+    date_created = mapped_column(DateTime, nullable=False, default=func.now(), index=True)
 
     def to_dict(self):
         return {
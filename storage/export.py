@@ -0,0 +1,137 @@
+"""Streaming bulk export of an event table for a date_created window.
+
+Rows are read from MySQL through a server-side cursor on the read pool
+(see read_db.py), `chunk_rows` at a time, as plain row tuples, and each chunk is encoded straight into the
+response. Nothing builds a dict per row, and memory stays at one chunk
+whatever the size of the window. Archived (cold) rows are streamed first,
+as Arrow record batches read directly from their Parquet files. (While a
+partition is being retired its rows briefly exist in both places, and an
+export taken in that moment contains them twice; trace_id identifies them.)
+An export that takes longer than `max_seconds` is cut off with TimeoutError,
+so it cannot hold a read connection indefinitely.
+
+Formats:
+    csv      gzip-compressed CSV with a header row, served as a .csv.gz file
+             (application/gzip, not Content-Encoding, so clients save it as is)
+    arrow    Arrow IPC stream, zstd-compressed buffers (needs pyarrow)
+    parquet  Parquet, zstd, one row group per chunk (needs pyarrow)
+"""
+import csv
+import io
+import time
+import zlib
+
+from archive import arrow_schema, pa
+from partitions import created_before
+from sqlalchemy import select
+
+if pa is not None:
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+
+FORMATS = {
+    "csv": ("application/gzip", "csv.gz"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+COLUMNAR_FORMATS = ("arrow", "parquet")
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are collected and handed out chunk by chunk"""
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+class TableExport:
+    def __init__(self, reader, archive, table, start, end, chunk_rows=10000, max_seconds=None):
+        self.reader = reader
+        self.archive = archive
+        self.table = table
+        self.start = start
+        self.end = end
+        self.chunk_rows = chunk_rows
+        self.max_seconds = max_seconds
+
+    def chunks(self):
+        """Archived record batches, then live row-tuple lists, oldest first"""
+        deadline = time.monotonic() + self.max_seconds if self.max_seconds else None
+        for batch in self.archive.batches(self.table, self.start, self.end, self.chunk_rows):
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Export did not finish within {self.max_seconds}s")
+            yield batch
+        date_created = self.table.c.date_created
+        statement = (select(self.table)
+                     .where(date_created >= self.start)
+                     .where(date_created < self.end)
+                     .where(created_before(self.table.c.trace_id, self.end))
+                     .order_by(date_created))
+        # The read connection only gets what is left of the export's time
+        remaining = max(deadline - time.monotonic(), 0.001) if deadline is not None else None
+        yield from self.reader.chunks(statement, self.chunk_rows, remaining)
+
+    def record_batches(self):
+        schema = arrow_schema(self.table)
+        for chunk in self.chunks():
+            if isinstance(chunk, pa.RecordBatch):
+                yield chunk.cast(schema)
+            else:
+                columns = zip(*chunk)
+                yield pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+
+    def csv(self, level=6):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow([column.name for column in self.table.columns])
+        for chunk in self.chunks():
+            if pa is not None and isinstance(chunk, pa.RecordBatch):
+                chunk = zip(*(column.to_pylist() for column in chunk.columns))
+            writer.writerows(chunk)
+            data = compressor.compress(text.getvalue().encode('utf-8'))
+            text.seek(0)
+            text.truncate()
+            if data:
+                yield data
+        yield compressor.compress(text.getvalue().encode('utf-8')) + compressor.flush()
+
+    def arrow(self):
+        sink = ChunkSink()
+        options = ipc.IpcWriteOptions(compression="zstd")
+        with ipc.new_stream(sink, arrow_schema(self.table), options=options) as writer:
+            for batch in self.record_batches():
+                writer.write_batch(batch)
+                yield sink.drain()
+        yield sink.drain()
+
+    def parquet(self):
+        sink = ChunkSink()
+        with pq.ParquetWriter(sink, arrow_schema(self.table), compression="zstd") as writer:
+            for batch in self.record_batches():
+                # One row group per chunk, so the encoded bytes can be flushed right away
+                writer.write_batch(batch, row_group_size=batch.num_rows)
+                yield sink.drain()
+        yield sink.drain()
+
+    def stream(self, fmt, gzip_level=6):
+        """Generator of encoded response chunks; raises ValueError if the format cannot be produced"""
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported export format: {fmt}")
+        if fmt in COLUMNAR_FORMATS and pa is None:
+            raise ValueError(f"{fmt} export needs pyarrow, which is not installed")
+        if fmt == "csv":
+            return self.csv(gzip_level)
+        return getattr(self, fmt)()
@@ -0,0 +1,27 @@
+from sqlalchemy import create_engine
+from event_models import Base
+from schema import migrate, table_problems
+import logging
+import yaml
+import os
+
+# Upgrades event tables created by an older create_tables.py (see schema.py); safe to run again
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# Load configuration file (prefer mounted config path, fallback to local file)
+config_path = '/config/storage/app_conf.yml'
+if not os.path.isfile(config_path):
+    config_path = 'app_conf.yml'
+with open(config_path, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+# Create a database engine for MySQL using configuration
+db_config = app_config['datastore']
+db_url = f"mysql+pymysql://{db_config['user']}:{db_config['password']}@{db_config['hostname']}:{db_config['port']}/{db_config['db']}"
+engine = create_engine(db_url)
+for table in Base.metadata.sorted_tables:
+    with engine.begin() as conn:
+        migrate(conn, table)
+        problems = table_problems(conn, table)
+    if problems:
+        raise SystemExit(f"{table.name} is still out of date: {'; '.join(problems)}")
@@ -0,0 +1,165 @@
+"""Time partitioning and retention for the event tables.
+
+The event tables are RANGE-partitioned on trace_id (see event_models.py).
+trace_ids are time-ordered, so each partition holds the events the receiver
+accepted during one day or month:
+
+    p20261018  VALUES LESS THAN (trace_id_at(2026-10-19))
+    p20261019  VALUES LESS THAN (trace_id_at(2026-10-20))
+    ...
+    p_future   VALUES LESS THAN (LEGACY_TRACE_ID_MIN)
+    p_legacy   VALUES LESS THAN MAXVALUE
+
+p_legacy holds the rows stored before trace_ids had a time layout: their
+epoch-ns ids sort after every new id. Its rows are archived (or dropped)
+together once the newest of them is older than the retention, and the
+partition is then emptied rather than dropped.
+
+maintain() runs periodically and:
+    - splits the next `precreate` periods off p_future, so inserts never land
+      in a partition that later has to be reorganised
+    - retires partitions that end more than `retention` periods ago: they are
+      streamed into the cold archive (expired: archive) and dropped, or just
+      dropped (expired: drop). Dropping a partition is a metadata operation,
+      unlike DELETE, so the live tables stay bounded at no extra cost.
+
+Range queries filter on date_created, which MySQL cannot prune by;
+created_before() adds the matching trace_id condition.
+"""
+import datetime
+import logging
+
+from sqlalchemy import or_, text
+
+from common.tracing import LEGACY_TRACE_ID_MIN, trace_id_at
+
+logger = logging.getLogger('basicLogger')
+
+FUTURE_PARTITION = "p_future"
+LEGACY_PARTITION = "p_legacy"
+# How far the receivers' clocks may run ahead of MySQL's
+CLOCK_SKEW = datetime.timedelta(minutes=5)
+
+
+def created_before(trace_id, end):
+    """Condition on a trace_id column that holds for every row created before `end`.
+
+    A trace_id is issued when the receiver accepts the event, before its row
+    is created, so MySQL can skip the partitions after `end`. There is no
+    matching lower bound: retries and dead-letter replays store events any
+    time later.
+    """
+    return or_(trace_id < trace_id_at(end + CLOCK_SKEW), trace_id >= LEGACY_TRACE_ID_MIN)
+
+
+class PartitionManager:
+    def __init__(self, engine, tables, archive, config):
+        self.engine = engine
+        self.tables = tables
+        self.archive = archive
+        self.period = config.get('period', 'day')
+        if self.period not in ('day', 'month'):
+            raise ValueError(f"Unsupported partition period: {self.period}")
+        self.precreate = config.get('precreate', 3)
+        self.retention = config.get('retention', 30)
+        self.expired = config.get('expired', 'archive')
+        self.chunk_rows = config.get('archive_chunk_rows', 50000)
+
+    def period_start(self, when):
+        start = when.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        return start.replace(day=1) if self.period == 'month' else start
+
+    def shift(self, start, periods):
+        """Start of the period `periods` after (or before, if negative) the one starting at `start`"""
+        if self.period == 'day':
+            return start + datetime.timedelta(days=periods)
+        months = start.year * 12 + start.month - 1 + periods
+        return start.replace(year=months // 12, month=months % 12 + 1)
+
+    def partition_name(self, start):
+        return f"p{start:%Y%m}" if self.period == 'month' else f"p{start:%Y%m%d}"
+
+    def partitions(self, conn, table_name):
+        """[(name, upper bound or None for MAXVALUE)] in order; [] if the table is not partitioned"""
+        rows = conn.execute(text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table ORDER BY PARTITION_ORDINAL_POSITION"),
+            {"table": table_name}).all()
+        return [(name, None if bound == "MAXVALUE" else int(bound)) for name, bound in rows if name is not None]
+
+    def ensure_future(self, conn, table_name, partitions, now):
+        """Splits partitions for the current and next `precreate` periods off p_future"""
+        future_bound = next((bound for name, bound in partitions if name == FUTURE_PARTITION), False)
+        if future_bound is False:
+            logger.error("%s has no %s partition; cannot add new partitions", table_name, FUTURE_PARTITION)
+            return
+        last_bound = max((bound for name, bound in partitions
+                          if name not in (FUTURE_PARTITION, LEGACY_PARTITION)), default=None)
+        current = self.period_start(now)
+        new = []
+        for i in range(self.precreate + 1):
+            start = self.shift(current, i)
+            bound = trace_id_at(self.shift(start, 1))
+            if last_bound is None or bound > last_bound:
+                new.append(f"PARTITION {self.partition_name(start)} VALUES LESS THAN ({bound})")
+        if not new:
+            return
+        new.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN "
+                   f"{'MAXVALUE' if future_bound is None else f'({future_bound})'}")
+        conn.execute(text(f"ALTER TABLE {table_name} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(new)})"))
+        logger.info("Added %d partition(s) to %s", len(new) - 1, table_name)
+
+    def retire_expired(self, conn, table, partitions, now):
+        """Archives (or just drops) partitions whose whole range is older than the retention"""
+        cutoff = trace_id_at(self.shift(self.period_start(now), -self.retention))
+        for name, bound in partitions:
+            if bound is None or bound > cutoff:
+                break
+            if self.expired == 'archive':
+                if not self.archive.available:
+                    logger.error("Cannot archive %s partition %s without pyarrow; keeping it", table.name, name)
+                    return
+                self.archive.write_partition(table, name, self.partition_rows(table, name))
+            conn.execute(text(f"ALTER TABLE {table.name} DROP PARTITION {name}"))
+            logger.info("Dropped %s partition %s (older than %d %s(s))", table.name, name, self.retention, self.period)
+
+    def retire_legacy(self, conn, table, now):
+        """Archives (or just drops) the legacy rows once the newest of them is older than the retention"""
+        newest = conn.execute(text(
+            f"SELECT MAX(date_created) FROM {table.name} PARTITION ({LEGACY_PARTITION})")).scalar()
+        if newest is None or newest >= self.shift(self.period_start(now), -self.retention):
+            return
+        if self.expired == 'archive':
+            if not self.archive.available:
+                logger.error("Cannot archive %s partition %s without pyarrow; keeping it", table.name, LEGACY_PARTITION)
+                return
+            # Dated, as legacy events re-delivered later can fill the partition again
+            self.archive.write_partition(table, f"{LEGACY_PARTITION}_{now:%Y%m%d}",
+                                         self.partition_rows(table, LEGACY_PARTITION))
+        # Emptied, not dropped: legacy trace_ids have nowhere else to go
+        conn.execute(text(f"ALTER TABLE {table.name} TRUNCATE PARTITION {LEGACY_PARTITION}"))
+        logger.info("Emptied %s partition %s (older than %d %s(s))",
+                    table.name, LEGACY_PARTITION, self.retention, self.period)
+
+    def partition_rows(self, table, partition):
+        """Streams a partition's rows in chunks on a separate connection (server-side cursor)"""
+        columns = ", ".join(column.name for column in table.columns)
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                text(f"SELECT {columns} FROM {table.name} PARTITION ({partition})"))
+            for chunk in result.partitions(self.chunk_rows):
+                yield chunk
+
+    def maintain(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for table in self.tables:
+            with self.engine.connect() as conn:
+                partitions = self.partitions(conn, table.name)
+                if not partitions:
+                    logger.error("%s is not partitioned; run migrate_tables.py", table.name)
+                    continue
+                self.ensure_future(conn, table.name, partitions, now)
+                partitions = self.partitions(conn, table.name)
+                self.retire_expired(conn, table, partitions, now)
+                if any(name == LEGACY_PARTITION for name, _ in partitions):
+                    self.retire_legacy(conn, table, now)
@@ -0,0 +1,80 @@
+"""Read path for the storage query endpoints.
+
+Range queries and exports used to share ENGINE with the Kafka consumer's
+writes, so a burst of slow reads could check out every pooled connection
+and stall ingest. Reads now go through their own engine, with a pool sized
+by the datastore.reads config:
+
+    pool_size / max_overflow   connections reserved for readers
+    pool_timeout               seconds a request waits for one before giving up
+    statement_timeout_ms       MySQL MAX_EXECUTION_TIME for range queries
+
+A request holds its read connection only for its own query. Exports hold
+one for as long as their server-side cursor is open, so they are capped by
+max_seconds: MySQL aborts the statement after that long, and the stream is
+cut off if the client reads too slowly to finish in time.
+"""
+import logging
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from partitions import created_before
+
+logger = logging.getLogger('basicLogger')
+
+
+class ReadPool:
+    def __init__(self, url, config):
+        self.pool_size = config.get('pool_size', 5)
+        self.max_overflow = config.get('max_overflow', 5)
+        self.statement_timeout_ms = config.get('statement_timeout_ms', 5000)
+        self.engine = create_engine(
+            url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=config.get('pool_timeout', 10),
+            pool_recycle=3600,
+            pool_pre_ping=True,
+        )
+        self.sessions = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    @staticmethod
+    def timed(statement, timeout_ms):
+        """Adds the MAX_EXECUTION_TIME hint, so MySQL aborts the statement after timeout_ms"""
+        if not timeout_ms:
+            return statement
+        return statement.prefix_with(f"/*+ MAX_EXECUTION_TIME({int(timeout_ms)}) */", dialect="mysql")
+
+    def readings(self, model, start, end):
+        """to_dict() of every row of `model` created between start and end"""
+        statement = (select(model)
+                     .where(model.date_created >= start)
+                     .where(model.date_created < end)
+                     .where(created_before(model.trace_id, end)))
+        with self.sessions() as session:
+            result = session.execute(self.timed(statement, self.statement_timeout_ms))
+            return [row.to_dict() for row in result.scalars()]
+
+    def chunks(self, statement, chunk_rows, max_seconds=None):
+        """Row-tuple lists of up to chunk_rows from a server-side cursor.
+
+        Raises TimeoutError once the cursor has been open for max_seconds.
+        """
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        statement = self.timed(statement, max_seconds * 1000 if max_seconds else None)
+        with self.engine.connect() as conn:
+            finished = False
+            try:
+                result = conn.execution_options(stream_results=True).execute(statement)
+                for rows in result.partitions(chunk_rows):
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError(f"Export did not finish within {max_seconds}s")
+                    yield rows
+                finished = True
+            finally:
+                if not finished:
+                    # Returning the connection would first read the rest of the
+                    # cursor (e.g. after the client disconnected); close it instead
+                    conn.invalidate()
@@ -0,0 +1,183 @@
+"""Retry topics and dead-letter topic for the storage consumer.
+
+A message that fails in process_messages is not retried inline, which would
+stall the ingest thread. It is re-published to the first retry tier and its
+offset is committed straight away. Each tier has a fixed delay and its own
+consumer thread:
+
+    events --fail--> events_retry_5s --fail--> events_retry_30s --fail--> ... --> events_dlq
+
+Every message in a tier waits the same delay, so messages become due in the
+order they were written and a tier only has to sleep until the head of its
+topic is due. Retry state travels inside the message under "retry":
+
+    {"attempt": 2, "not_before": 1700000000.5, "error": "...", "replayed": 0}
+
+Messages that are not valid JSON go straight to the dead-letter topic, as
+retrying cannot fix them. replay_dead_letters() moves dead-lettered messages
+back to the first tier in bulk, e.g. once the bug that broke them is fixed.
+
+A message is only committed once it is stored or handed to the next topic.
+If that topic cannot be written to, fail() raises HandoffError. The caller
+then leaves the offset uncommitted and resumes from it after a pause.
+"""
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from common.event_bus import make_consumer, make_producer, retry_sleep
+from common.metrics import KAFKA_MESSAGES
+
+logger = logging.getLogger('basicLogger')
+
+
+class HandoffError(Exception):
+    """A failed message could not be published to its retry or dead-letter topic"""
+
+
+class RetryQueue:
+    def __init__(self, events_config, handler, consumer_group):
+        """handler(msg_obj) stores one decoded message and raises on failure"""
+        retry_config = events_config.get('retry') or {}
+        self.events_config = events_config
+        self.handler = handler
+        self.consumer_group = consumer_group
+        # Backoff tiers, tried in order: [{"topic": ..., "delay_seconds": ...}, ...]
+        self.tiers = retry_config.get('tiers') or []
+        self.dead_letter_topic = retry_config.get('dead_letter_topic')
+        self.replay_timeout_ms = retry_config.get('replay_timeout_ms', 2000)
+        self.producers = {}
+        self.producers_lock = threading.Lock()
+        # Held while replaying, by any thread or server worker in the container
+        self.replay_lock_file = os.path.join(tempfile.gettempdir(), f"{consumer_group}.dead_letter_replay.lock")
+
+    def producer(self, topic):
+        """One producer per topic, created on first use and shared by all threads"""
+        with self.producers_lock:
+            if topic not in self.producers:
+                self.producers[topic] = make_producer(self.events_config, topic=topic)
+            return self.producers[topic]
+
+    def publish(self, topic, msg_obj):
+        if self.producer(topic).produce(json.dumps(msg_obj).encode('utf-8')):
+            return True
+        logger.error("Could not publish message to %s", topic)
+        return False
+
+    def fail(self, msg_obj, error):
+        """Routes a message that could not be stored to the next retry tier, or the dead-letter topic.
+
+        Raises HandoffError if that topic cannot be written to; the message
+        must then not be committed.
+        """
+        retry = dict(msg_obj.get('retry') or {})
+        attempt = retry.get('attempt', 0)
+        retry['attempt'] = attempt + 1
+        retry['error'] = str(error)
+        msg_obj['retry'] = retry
+        trace_id = (msg_obj.get('payload') or {}).get('trace_id')
+        if attempt < len(self.tiers):
+            tier = self.tiers[attempt]
+            retry['not_before'] = time.time() + tier['delay_seconds']
+            logger.warning("Message trace_id=%s failed (%s); retrying in %ss via %s",
+                           trace_id, error, tier['delay_seconds'], tier['topic'])
+            if not self.publish(tier['topic'], msg_obj):
+                raise HandoffError(f"Could not hand trace_id={trace_id} to {tier['topic']}")
+            KAFKA_MESSAGES.labels(topic=tier['topic'], direction="produced", outcome="retried").inc()
+            return
+        if self.dead_letter_topic is None:
+            logger.error("Message trace_id=%s failed (%s) and no dead-letter topic is configured; dropping it",
+                         trace_id, error)
+            return
+        logger.error("Message trace_id=%s failed %d times (%s); moving it to %s",
+                     trace_id, retry['attempt'], error, self.dead_letter_topic)
+        if not self.publish(self.dead_letter_topic, msg_obj):
+            raise HandoffError(f"Could not hand trace_id={trace_id} to {self.dead_letter_topic}")
+        KAFKA_MESSAGES.labels(topic=self.dead_letter_topic, direction="produced", outcome="dead_lettered").inc()
+
+    def fail_undecodable(self, value, error):
+        """Messages that are not valid JSON skip the retry tiers"""
+        msg_obj = {"raw": value.decode('utf-8', errors='replace'), "retry": {"attempt": len(self.tiers)}}
+        self.fail(msg_obj, error)
+
+    def run_tier(self, index):
+        """Consumes one retry tier: waits until each message is due, then stores it again"""
+        tier = self.tiers[index]
+        consumer = make_consumer(self.events_config, consumer_group=f"{self.consumer_group}_retry_{index}",
+                                 topic=tier['topic'], auto_offset_reset="earliest")
+        logger.info("Retry tier %d consuming %s (delay %ss)", index, tier['topic'], tier['delay_seconds'])
+        while True:
+            try:
+                for msg in consumer.messages():
+                    self.retry(tier, msg)
+                    consumer.commit()
+            except HandoffError as e:
+                logger.error(f"{e}; retry tier {index} resumes from its last commit")
+                consumer.restart()
+                retry_sleep()
+
+    def retry(self, tier, msg):
+        """Stores one message of a tier once it is due, or hands it on; raises HandoffError"""
+        try:
+            msg_obj = json.loads(msg.value.decode('utf-8'))
+        except ValueError as e:
+            self.fail_undecodable(msg.value, e)
+            return
+        delay = msg_obj.get('retry', {}).get('not_before', 0) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            self.handler(msg_obj)
+            logger.info("Retry of trace_id=%s succeeded on attempt %d",
+                        (msg_obj.get('payload') or {}).get('trace_id'), msg_obj['retry']['attempt'] + 1)
+            KAFKA_MESSAGES.labels(topic=tier['topic'], direction="consumed", outcome="ok").inc()
+        except Exception as e:
+            KAFKA_MESSAGES.labels(topic=tier['topic'], direction="consumed", outcome="failed").inc()
+            self.fail(msg_obj, e)
+
+    def start(self):
+        for index in range(len(self.tiers)):
+            t = threading.Thread(target=self.run_tier, args=(index,), daemon=True)
+            t.start()
+        logger.info("Started %d retry tier thread(s); dead-letter topic: %s", len(self.tiers), self.dead_letter_topic)
+
+    def replay_dead_letters(self, limit=None):
+        """Moves up to `limit` dead-lettered messages back to the first retry tier, due immediately.
+
+        Returns the number of messages replayed. Messages that still fail go
+        through all the tiers again before landing back on the dead-letter topic.
+        """
+        if not self.tiers or self.dead_letter_topic is None:
+            raise ValueError("Retry tiers and a dead-letter topic must be configured to replay")
+        with open(self.replay_lock_file, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            consumer = make_consumer(self.events_config, consumer_group=f"{self.consumer_group}_dead_letter",
+                                     timeout_ms=self.replay_timeout_ms, topic=self.dead_letter_topic,
+                                     auto_offset_reset="earliest")
+            replayed = 0
+            try:
+                for msg in consumer.messages():
+                    msg_obj = json.loads(msg.value.decode('utf-8'))
+                    if 'raw' in msg_obj:
+                        # Still not valid JSON; nothing a replay can do for it
+                        logger.warning("Skipping undecodable dead-lettered message at offset %s", msg.offset)
+                    else:
+                        retry = msg_obj.setdefault('retry', {})
+                        retry['attempt'] = 0
+                        retry['not_before'] = time.time()
+                        retry['replayed'] = retry.get('replayed', 0) + 1
+                        if not self.publish(self.tiers[0]['topic'], msg_obj):
+                            break
+                        replayed += 1
+                    # Commit per message so a crash mid-replay never publishes a message twice
+                    consumer.commit()
+                    if limit is not None and replayed >= limit:
+                        break
+            finally:
+                consumer.stop()
+            logger.info("Replayed %d dead-lettered message(s) to %s", replayed, self.tiers[0]['topic'])
+            return replayed
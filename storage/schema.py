@@ -0,0 +1,94 @@
+"""Checks the event tables against event_models.py and migrates old ones.
+
+create_tables.py (create_all) only creates tables that do not exist yet. A
+table created before trace_id became unique and the tables became
+partitioned keeps its old layout. store_rows' ON DUPLICATE KEY UPDATE then
+has no key to match, and re-delivered events are inserted again. So storage
+does not consume events while table_problems() reports anything, and
+migrate_tables.py runs migrate() to bring such a table up to date.
+
+A table partitioned without p_legacy keeps its legacy epoch-ns trace_ids in
+p_future, where they are never retired and are copied again every time
+maintenance splits a partition off. migrate() moves them into p_legacy.
+"""
+import logging
+
+from sqlalchemy import UniqueConstraint, inspect, text
+
+from common.tracing import LEGACY_TRACE_ID_MIN
+from event_models import PARTITION_BY
+from partitions import FUTURE_PARTITION, LEGACY_PARTITION
+
+logger = logging.getLogger('basicLogger')
+
+
+def unique_columns(conn, table_name):
+    """Column lists of the table's unique keys, primary key included"""
+    rows = conn.execute(text(
+        "SELECT INDEX_NAME, GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND NON_UNIQUE = 0 GROUP BY INDEX_NAME"),
+        {"table": table_name}).all()
+    return [columns.split(",") for _, columns in rows]
+
+
+def partition_names(conn, table_name):
+    return [name for name, in conn.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL"),
+        {"table": table_name})]
+
+
+def partition_expression(conn, table_name):
+    """The RANGE partitioning column of the table, or None if it is not range-partitioned"""
+    row = conn.execute(text(
+        "SELECT PARTITION_METHOD, PARTITION_EXPRESSION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL LIMIT 1"),
+        {"table": table_name}).first()
+    if row is None or row[0] != "RANGE":
+        return None
+    return row[1].strip("`")
+
+
+def table_problems(conn, table):
+    """What keeps an existing table from matching its model; None if the table does not exist yet"""
+    if not inspect(conn).has_table(table.name):
+        return None
+    problems = []
+    if ["trace_id"] not in unique_columns(conn, table.name):
+        problems.append("trace_id is not unique")
+    if partition_expression(conn, table.name) != "trace_id":
+        problems.append("not range-partitioned on trace_id")
+    elif LEGACY_PARTITION not in partition_names(conn, table.name):
+        problems.append(f"no {LEGACY_PARTITION} partition for legacy trace_ids")
+    return problems
+
+
+def migrate(conn, table):
+    """Brings an existing table up to date with its model; steps already done are skipped"""
+    if not inspect(conn).has_table(table.name):
+        logger.info("%s does not exist; create_tables.py creates it", table.name)
+        return
+    if ["trace_id"] not in unique_columns(conn, table.name):
+        # Keep the first copy of every re-delivered event
+        deleted = conn.execute(text(
+            f"DELETE t1 FROM {table.name} t1 JOIN {table.name} t2 ON t1.trace_id = t2.trace_id AND t1.id > t2.id"
+        )).rowcount
+        logger.info("Deleted %d duplicate rows from %s", deleted, table.name)
+        constraint = next(c.name for c in table.constraints if isinstance(c, UniqueConstraint))
+        # MySQL wants the partitioning column in every unique key, the primary key included
+        conn.execute(text(f"ALTER TABLE {table.name} DROP PRIMARY KEY, ADD PRIMARY KEY (id, trace_id), "
+                          f"ADD CONSTRAINT {constraint} UNIQUE (trace_id)"))
+        logger.info("Made trace_id unique in %s", table.name)
+    if "date_created" not in [i["column_names"][0] for i in inspect(conn).get_indexes(table.name)]:
+        index = next(i for i in table.indexes if [c.name for c in i.columns] == ["date_created"])
+        conn.execute(text(f"CREATE INDEX {index.name} ON {table.name} (date_created)"))
+        logger.info("Indexed date_created in %s", table.name)
+    if partition_expression(conn, table.name) != "trace_id":
+        conn.execute(text(f"ALTER TABLE {table.name} PARTITION BY {PARTITION_BY}"))
+        logger.info("Partitioned %s on trace_id", table.name)
+    elif LEGACY_PARTITION not in partition_names(conn, table.name):
+        conn.execute(text(
+            f"ALTER TABLE {table.name} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ("
+            f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN ({LEGACY_TRACE_ID_MIN}), "
+            f"PARTITION {LEGACY_PARTITION} VALUES LESS THAN MAXVALUE)"))
+        logger.info("Moved the legacy trace_ids of %s to %s", table.name, LEGACY_PARTITION)
@@ -0,0 +1,107 @@
+"""Read-through cache for range queries over closed time windows.
+
+date_created is set by MySQL when a row is inserted, so once a window ends
+more than `closed_after_seconds` in the past (enough to cover in-flight
+batches), no new row can fall inside it and its result is final. Only such
+closed windows are cached; windows reaching into the present always go to
+MySQL.
+
+Results are cached as the serialized JSON response body, keyed on
+
+    (table, start, end, filters)
+
+and evicted least-recently-used once the bodies add up to more than
+max_bytes. Hits, misses and bypasses (open windows) are counted in the
+result_cache_requests_total metric.
+
+Each server worker has its own cache. invalidate() clears them all: it
+touches /tmp/<name>.cache.reset, and every worker drops its entries when it
+next sees that file change.
+"""
+import datetime
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from common.metrics import RESULT_CACHE_BYTES, RESULT_CACHE_ENTRIES, RESULT_CACHE_EVICTIONS, RESULT_CACHE_REQUESTS
+
+
+class WindowCache:
+    def __init__(self, name, max_bytes=64 * 1024 * 1024, closed_after_seconds=60):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.closed_after = datetime.timedelta(seconds=closed_after_seconds)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.reset_file = os.path.join(tempfile.gettempdir(), f"{name}.cache.reset")
+        self.reset_seen = self.reset_mtime()
+
+    def closed(self, end):
+        """True if a window ending at `end` (naive UTC) can no longer gain rows"""
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return end < now - self.closed_after
+
+    def get(self, key, end, load):
+        """The cached body for `key`, or load() (which returns bytes), cached if the window is closed"""
+        table = key[0]
+        if not self.closed(end):
+            RESULT_CACHE_REQUESTS.labels(cache=self.name, table=table, outcome="bypass").inc()
+            return load()
+        self.check_reset()
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+        if body is not None:
+            RESULT_CACHE_REQUESTS.labels(cache=self.name, table=table, outcome="hit").inc()
+            return body
+        RESULT_CACHE_REQUESTS.labels(cache=self.name, table=table, outcome="miss").inc()
+        body = load()
+        self.put(key, body)
+        return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                RESULT_CACHE_EVICTIONS.labels(cache=self.name).inc()
+            self.report()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.report()
+
+    def reset_mtime(self):
+        try:
+            return os.stat(self.reset_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def check_reset(self):
+        """Clears this worker's entries if another process invalidated the cache"""
+        mtime = self.reset_mtime()
+        if mtime != self.reset_seen:
+            self.reset_seen = mtime
+            self.clear()
+
+    def invalidate(self):
+        """Clears the cache in every worker process of the container"""
+        with open(self.reset_file, 'a'):
+            os.utime(self.reset_file)
+        self.check_reset()
+
+    def report(self):
+        RESULT_CACHE_BYTES.labels(cache=self.name).set(self.size)
+        RESULT_CACHE_ENTRIES.labels(cache=self.name).set(len(self.entries))